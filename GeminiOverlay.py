@@ -1,21 +1,2389 @@
+import time
+_LAUNCHED = time.perf_counter()
 import customtkinter as ctk
 import keyboard
 import threading
 import tkinter as tk
 from tkinter import messagebox
-import google.generativeai as genai
 import os
+import sys
+import logging
+import logging.handlers
 import json
-import time
-from datetime import datetime
+import enum
+import tracemalloc
+import random
+from datetime import timedelta
+from contextlib import contextmanager
+import argparse
+import bisect
+import collections
+import itertools
+import queue
+import hashlib
+import zlib
+import re
+import sqlite3
+import http.server
+import http.client
+import secrets
+import urllib.parse
+_IMPORTED = time.perf_counter()
+
+logger = logging.getLogger(__name__)
+
+# google.generativeai takes longer to import than everything else combined,
+# so it is loaded in the background after the hotkey and window are up.
+genai = None
+_genai_lock = threading.Lock()
+
+
+def load_genai():
+    """Import the Gemini SDK on first use and return the module"""
+    global genai
+    with _genai_lock:
+        if genai is None:
+            import google.generativeai as sdk
+            genai = sdk
+    return genai
+
+
+# NumPy is only needed for the optional retrieval index, so it is imported on
+# first use and a missing install just leaves retrieval off.
+np = None
+
+
+def load_numpy():
+    """Import NumPy on first use; returns None if it isn't installed"""
+    global np
+    if np is None:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            return None
+    return np
+
+
+class DuplicateFilter(logging.Filter):
+    """Collapses repeated warnings and errors into counted summaries.
+
+    The first occurrence of a message (same call site, text and exception)
+    within ``window`` seconds is logged; repeats are only counted, and the
+    count is attached to the next occurrence let through or flushed at
+    shutdown. Below WARNING everything passes untouched.
+    """
+
+    def __init__(self, window=60.0, max_tracked=1000):
+        super().__init__()
+        self.window = window
+        self.max_tracked = max_tracked
+        self.seen = {}  # signature -> [first seen, suppressed count, message]
+        self.lock = threading.Lock()
+    
+    def signature(self, record):
+        exc = record.exc_info[1] if record.exc_info else None
+        return (record.levelno, record.pathname, record.lineno, record.getMessage(),
+                type(exc).__name__ if exc else None)
+    
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = self.signature(record)
+        with self.lock:
+            state = self.seen.get(key)
+            if state and record.created - state[0] < self.window:
+                state[1] += 1
+                return False
+            suppressed = state[1] if state else 0
+            self.seen[key] = [record.created, 0, key[3]]
+            if len(self.seen) > self.max_tracked:
+                oldest = min(self.seen, key=lambda k: self.seen[k][0])
+                del self.seen[oldest]
+        if suppressed:
+            record.msg = f"{record.msg} (repeated {suppressed} more times in the previous {self.window:.0f}s)"
+        return True
+    
+    def pending_summaries(self):
+        """Messages whose repeats have been counted but not reported yet"""
+        with self.lock:
+            pending = [(state[2], state[1]) for state in self.seen.values() if state[1]]
+            for state in self.seen.values():
+                state[1] = 0
+        return pending
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_log_listener = None
+_log_handler = None
+
+
+def setup_logging(level="INFO", path='gemini_overlay.log', max_bytes=1024 * 1024, backup_count=3):
+    """Route all logging through a background queue to a rotating file and the console"""
+    global _log_listener, _log_handler
+    log_queue = queue.Queue(maxsize=10000)
+    
+    file_handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True
+    )
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    handlers = [file_handler]
+    if sys.stderr is not None:  # No console when frozen as a GUI app
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter('%(message)s'))
+        handlers.append(console_handler)
+    
+    _log_handler = NonBlockingQueueHandler(log_queue)
+    _log_handler.addFilter(DuplicateFilter())
+    root = logging.getLogger()
+    root.handlers = [_log_handler]
+    root.setLevel(level)
+    
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+
+
+def shutdown_logging():
+    """Report suppressed repeats and drain the log queue"""
+    global _log_listener
+    if _log_listener is None:
+        return
+    for duplicate_filter in _log_handler.filters:
+        for message, count in duplicate_filter.pending_summaries():
+            logger.warning("Suppressed %d repeats of: %s", count, message)
+    if _log_handler.dropped:
+        logger.warning("Dropped %d log records while the log queue was full", _log_handler.dropped)
+    _log_listener.stop()
+    _log_listener = None
+
+
+class StartupProfiler:
+    """Records how long each startup phase takes (printed with --startup-profile)"""
+
+    def __init__(self, enabled=False, origin=_LAUNCHED):
+        self.enabled = enabled
+        self.origin = origin
+        self.phases = []  # (name, thread name, start offset, duration)
+        self.lock = threading.Lock()
+        self.reported = False
+        self.record("module imports", origin, _IMPORTED)
+    
+    def record(self, name, started, ended):
+        with self.lock:
+            self.phases.append((name, threading.current_thread().name, started - self.origin, ended - started))
+    
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started, time.perf_counter())
+    
+    def milestone(self, name):
+        """Record a point in time measured from launch"""
+        self.record(f"⏱️ {name}", self.origin, time.perf_counter())
+    
+    def report(self):
+        if not self.enabled or self.reported:
+            return
+        self.reported = True
+        with self.lock:
+            phases = sorted(self.phases, key=lambda phase: phase[2] + phase[3])
+        print("\n📊 Startup profile (ms since launch)")
+        print(f"{'phase':<32}{'thread':<20}{'start':>10}{'took':>10}")
+        for name, thread, start, duration in phases:
+            if name.startswith("⏱️"):
+                print(f"{name:<32}{thread:<20}{'':>10}{duration * 1000:>10.1f}")
+            else:
+                print(f"{name:<32}{thread:<20}{start * 1000:>10.1f}{duration * 1000:>10.1f}")
+        print("-" * 72)
+
+class Role(enum.Enum):
+    USER = "user"
+    ASSISTANT = "assistant"
+
+
+class Message:
+    """One chat message, kept small for long histories.
+
+    The role is an enum member, mode/model ids and notes are interned, and
+    the time is an epoch float that is only formatted when the message is
+    drawn. ``to_dict``/``from_dict`` convert to and from the JSON shape of
+    the history journal and gemini_history.json; records written before
+    ``time`` was stored keep their pre-formatted label in
+    ``legacy_timestamp``.
+    """
+    __slots__ = ("role", "content", "created", "mode", "model", "note", "seq", "request_id", "legacy_timestamp",
+                 "layout")
+
+    def __init__(self, role, content, created=None, mode=None, model=None, note=None, seq=None, request_id=None,
+                 legacy_timestamp=None):
+        self.role = role
+        self.content = content
+        self.created = time.time() if created is None else created
+        self.mode = sys.intern(mode) if mode else None
+        self.model = sys.intern(model) if model else None
+        self.note = sys.intern(note) if note else None
+        self.seq = seq
+        self.request_id = request_id
+        self.legacy_timestamp = legacy_timestamp
+        self.layout = None  # (content, segments) while the message is on screen, see layout_entry
+    
+    @classmethod
+    def from_dict(cls, record):
+        created = record.get("time")
+        return cls(
+            Role(record.get("type", "assistant")),
+            record.get("content", ""),
+            created=created if created is not None else 0.0,
+            mode=record.get("mode"),
+            model=record.get("model"),
+            note=record.get("note"),
+            seq=record.get("seq"),
+            legacy_timestamp=None if created is not None else record.get("timestamp", "")
+        )
+    
+    def to_dict(self, timestamp):
+        """Journal record; ``timestamp`` is the display label older readers show as-is"""
+        record = {"type": self.role.value, "content": self.content, "timestamp": timestamp}
+        if self.legacy_timestamp is None:
+            record["time"] = self.created
+        if self.mode:
+            record["mode"] = self.mode
+        if self.model:
+            record["model"] = self.model
+        if self.note:
+            record["note"] = self.note
+        return record
+
+
+def benchmark_message_memory(count=100000):
+    """Print the memory held by ``count`` chat messages as dicts versus Message records"""
+    modes = ["Normal", "Coder", "Teacher", "Concise"]
+    contents = [f"Message {i}: " + "lorem ipsum dolor sit amet " * 8 for i in range(count)]
+    
+    def measure(build):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        history = build()
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        del history
+        return used
+    
+    def as_dicts():
+        return [{
+            "type": "assistant" if i % 2 else "user",
+            "content": contents[i],
+            "timestamp": f"{i // 60 % 24:02d}:{i % 60:02d} • 💬 {modes[i % 4]} • ⚡ {i % 30 / 10:.1f}s" if i % 2
+            else f"{i // 60 % 24:02d}:{i % 60:02d}",
+            "mode": modes[i % 4],
+            "seq": i
+        } for i in range(count)]
+    
+    def as_messages():
+        started = time.time()
+        return [Message(Role.ASSISTANT if i % 2 else Role.USER, contents[i], created=started + i,
+                        mode=modes[i % 4], note=f"⚡ {i % 30 / 10:.1f}s" if i % 2 else None, seq=i)
+                for i in range(count)]
+    
+    def as_displayed():
+        # Messages on screen also hold their parsed layout
+        messages = as_messages()
+        for message in messages:
+            message.layout = (message.content, parse_markdown(message.content))
+        return messages
+    
+    dict_bytes = measure(as_dicts)
+    message_bytes = measure(as_messages)
+    displayed_bytes = measure(as_displayed)
+    print(f"\n🧮 {count} messages (content shared, {sum(len(c) for c in contents) / 1e6:.1f} MB not counted)")
+    print(f"   dicts:    {dict_bytes / 1e6:8.1f} MB ({dict_bytes / count:.0f} bytes/message)")
+    print(f"   Message:  {message_bytes / 1e6:8.1f} MB ({message_bytes / count:.0f} bytes/message)")
+    print(f"   saving:   {(1 - message_bytes / dict_bytes) * 100:.0f}%")
+    print(f"   on screen:{displayed_bytes / 1e6:8.1f} MB ({displayed_bytes / count:.0f} bytes/message, "
+          "only for messages inside the chat window)")
+
+
+class HistoryStore:
+    """Append-only chat history journal split into JSONL segments.
+
+    Every message is one JSON line carrying a monotonically increasing
+    ``seq``. Appends are flushed and fsynced, a torn last line left by a
+    crash is cut off on open, and clearing writes a marker so the old
+    segments can be dropped by compaction instead of rewritten.
+    """
+
+    def __init__(self, directory='gemini_history', segment_size=5000, legacy_file='gemini_history.json'):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.segments = []  # First seq of each segment, ascending
+        self.next_seq = 0
+        self.segment_count = 0  # Lines in the newest segment
+        self.handle = None
+        
+        os.makedirs(self.directory, exist_ok=True)
+        self.open_segments()
+        if not self.segments and legacy_file and os.path.exists(legacy_file):
+            self.import_legacy(legacy_file)
+    
+    def segment_path(self, first_seq):
+        return os.path.join(self.directory, f"segment-{first_seq:09d}.jsonl")
+    
+    def open_segments(self):
+        """Discover existing segments and repair a torn tail"""
+        for name in os.listdir(self.directory):
+            if name.startswith("segment-") and name.endswith(".jsonl"):
+                try:
+                    self.segments.append(int(name[8:-6]))
+                except ValueError:
+                    continue
+        self.segments.sort()
+        if not self.segments:
+            return
+        
+        path = self.segment_path(self.segments[-1])
+        with open(path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                # A crash interrupted the last append: drop the partial line
+                data = data[:data.rfind(b"\n") + 1]
+                f.seek(0)
+                f.truncate(len(data))
+        lines = data.splitlines()
+        self.segment_count = len(lines)
+        self.next_seq = self.segments[-1]
+        for line in reversed(lines):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "seq" in record:
+                self.next_seq = record["seq"] + 1
+                break
+    
+    def import_legacy(self, legacy_file):
+        """One-time import of the old single-file gemini_history.json"""
+        try:
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            for entry in entries:
+                self.append(dict(entry), sync=False)
+            self.sync()
+            logger.info("Imported %s messages from %s", len(entries), legacy_file)
+        except Exception as e:
+            logger.error("Error importing legacy history: %s", e)
+    
+    def write_line(self, record, sync=True):
+        if self.handle is None or self.segment_count >= self.segment_size:
+            self.roll_segment()
+        self.handle.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.segment_count += 1
+        if sync:
+            self.sync()
+    
+    def sync(self):
+        if self.handle:
+            self.handle.flush()
+            os.fsync(self.handle.fileno())
+    
+    def roll_segment(self, force=False):
+        """Continue the newest segment, or start a new one when it is full"""
+        if self.handle:
+            self.handle.close()
+            self.handle = None
+        if force or not self.segments or self.segment_count >= self.segment_size:
+            self.segments.append(self.next_seq)
+            self.segment_count = 0
+        self.handle = open(self.segment_path(self.segments[-1]), 'a', encoding='utf-8')
+    
+    def append(self, *entries, sync=True):
+        """Append messages together and return the last sequence number"""
+        with self.lock:
+            for entry in entries:
+                entry["seq"] = self.next_seq
+                self.write_line(entry, sync=False)
+                self.next_seq += 1
+            if sync:
+                self.sync()
+            return self.next_seq - 1
+    
+    def clear(self):
+        """Mark everything written so far as cleared and compact it away"""
+        with self.lock:
+            self.write_line({"clear": True, "before": self.next_seq})
+            # Start a fresh segment after the marker, unless nothing was written since the last roll
+            if self.segments[-1] != self.next_seq:
+                self.roll_segment(force=True)
+        self.compact()
+    
+    def compact(self):
+        """Delete segments that lie entirely before the latest clear marker"""
+        with self.lock:
+            if not self.segments:
+                return
+            live = self.segments[-1]
+            cutoff = None
+            for first_seq in reversed(self.segments):
+                for record in self.read_segment_reversed(first_seq):
+                    if record.get("clear"):
+                        # The segment being appended to is never removed, only the ones before it
+                        cutoff = first_seq if first_seq != live else first_seq - 1
+                        break
+                if cutoff is not None:
+                    break
+            if cutoff is None:
+                return
+            for first_seq in [seq for seq in self.segments[:-1] if seq <= cutoff and seq != live]:
+                try:
+                    os.remove(self.segment_path(first_seq))
+                    self.segments.remove(first_seq)
+                except OSError as e:
+                    logger.warning("Error compacting history segment: %s", e)
+    
+    def read_segment_reversed(self, first_seq, block_size=65536):
+        """Yield the records of one segment from newest to oldest"""
+        path = self.segment_path(first_seq)
+        try:
+            with open(path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                position = f.tell()
+                remainder = b""
+                while position > 0:
+                    step = min(block_size, position)
+                    position -= step
+                    f.seek(position)
+                    lines = (f.read(step) + remainder).split(b"\n")
+                    remainder = lines.pop(0)
+                    for line in reversed(lines):
+                        if line.strip():
+                            yield from self.decode(line)
+                if remainder.strip():
+                    yield from self.decode(remainder)
+        except FileNotFoundError:
+            return
+    
+    def decode(self, line):
+        try:
+            yield json.loads(line)
+        except ValueError:
+            pass
+    
+    def tail(self, limit):
+        """Return the newest ``limit`` messages since the last clear, oldest first"""
+        with self.lock:
+            segments = list(self.segments)
+            if self.handle:
+                self.handle.flush()
+        entries = []
+        for first_seq in reversed(segments):
+            for record in self.read_segment_reversed(first_seq):
+                if record.get("clear"):
+                    return entries[::-1]
+                entries.append(record)
+                if len(entries) >= limit:
+                    return entries[::-1]
+        return entries[::-1]
+    
+    def read_range(self, start_seq, end_seq):
+        """Return stored messages with start_seq <= seq < end_seq, oldest first"""
+        with self.lock:
+            segments = list(self.segments)
+            if self.handle:
+                self.handle.flush()
+        first = max(bisect.bisect_right(segments, start_seq) - 1, 0)
+        entries = []
+        for first_seq in segments[first:]:
+            if first_seq >= end_seq:
+                break
+            try:
+                with open(self.segment_path(first_seq), 'r', encoding='utf-8') as f:
+                    for line in f:
+                        for record in self.decode(line):
+                            if record.get("clear"):
+                                entries = []  # Everything before a clear is gone
+                            elif start_seq <= record.get("seq", -1) < end_seq:
+                                entries.append(record)
+            except FileNotFoundError:
+                continue
+        return entries
+    
+    def close(self):
+        with self.lock:
+            if self.handle:
+                self.sync()
+                self.handle.close()
+                self.handle = None
+
+
+class SearchIndex:
+    """Persistent full-text index over the history journal.
+
+    Backed by an SQLite FTS5 table whose rowid is the journal ``seq``, so
+    hits can be mapped straight back to stored messages. Ranking uses the
+    built-in BM25 ``rank``.
+    """
+
+    def __init__(self, path=os.path.join('gemini_history', 'search.db')):
+        self.lock = threading.Lock()
+        self.available = False
+        try:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5("
+                "content, role UNINDEXED, timestamp UNINDEXED, tokenize='unicode61 remove_diacritics 2')"
+            )
+            self.conn.commit()
+            self.available = True
+        except sqlite3.Error as e:
+            logger.warning("Search index unavailable: %s", e)
+            self.conn = None
+    
+    def add(self, *entries):
+        """Index stored entries (they must already carry a seq)"""
+        rows = [(entry["seq"], entry["content"], entry["type"], entry.get("timestamp", ""))
+                for entry in entries if "seq" in entry]
+        if not self.available or not rows:
+            return
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO messages(rowid, content, role, timestamp) VALUES (?, ?, ?, ?)", rows
+            )
+            self.conn.commit()
+    
+    def last_seq(self):
+        with self.lock:
+            row = self.conn.execute("SELECT max(rowid) FROM messages").fetchone()
+        return -1 if row[0] is None else row[0]
+    
+    def catch_up(self, history_store, batch_size=2000):
+        """Index journal entries written while the index was not updated"""
+        if not self.available:
+            return
+        start = self.last_seq() + 1
+        while start < history_store.next_seq:
+            end = start + batch_size
+            self.add(*history_store.read_range(start, end))
+            start = end
+    
+    def search(self, query, limit=20):
+        """Return ranked hits as (seq, role, timestamp, snippet) tuples"""
+        terms = re.findall(r"\w+", query.lower())
+        if not self.available or not terms:
+            return []
+        # Quote every term so user input can't inject FTS syntax; prefix-match the last one
+        match = " ".join(f'"{term}"' for term in terms[:-1])
+        match = f'{match} "{terms[-1]}"*'.strip()
+        with self.lock:
+            return self.conn.execute(
+                "SELECT rowid, role, timestamp, snippet(messages, 0, '«', '»', '…', 16) "
+                "FROM messages WHERE messages MATCH ? ORDER BY rank LIMIT ?",
+                (match, limit)
+            ).fetchall()
+    
+    def clear(self):
+        if not self.available:
+            return
+        with self.lock:
+            self.conn.execute("DELETE FROM messages")
+            self.conn.commit()
+    
+    def close(self):
+        if self.conn:
+            with self.lock:
+                self.conn.close()
+            self.conn = None
+            self.available = False
+
+
+def hashing_embedding(texts, dim=512):
+    """Default offline embedding: signed feature hashing of words and word pairs.
+
+    Returns a float32 array of L2-normalised rows, one per text. Any callable
+    with the same shape of input and output can be used in its place.
+    """
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        words = re.findall(r"\w+", text.lower())
+        hashes = [zlib.crc32(feature.encode("utf-8"))
+                  for feature in itertools.chain(words, map(" ".join, zip(words, words[1:])))]
+        if hashes:
+            hashes = np.array(hashes, dtype=np.int64)
+            np.add.at(vectors[row], hashes % dim, np.where(hashes & 0x80000000, 1.0, -1.0))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-9)
+
+
+class VectorIndex:
+    """Persistent embedding index over the history journal, for retrieval.
+
+    Each stored message becomes one L2-normalised float32 row appended to
+    ``vectors.f32``, with its journal ``seq`` appended to ``seqs.i64``, its
+    role and text appended as a JSON line to ``texts.jsonl`` and that line's
+    byte offset to ``offsets.i64``, so hits are read back without decoding
+    journal segments. Searches read the arrays through ``numpy.memmap``, so
+    the index is never loaded into memory, and inserts are plain appends.
+    ``meta.json`` records which embedding built the index; a different
+    embedding or dimension starts it over, and ``catch_up`` refills it from
+    the journal.
+    """
+
+    def __init__(self, directory, embed=hashing_embedding):
+        self.directory = directory
+        self.embed = embed
+        self.lock = threading.Lock()
+        self.available = False
+        self.count = 0
+        self.last_seq = -1
+        self.mapped = None  # (vectors, seqs, offsets) memmaps, reopened after inserts
+        if load_numpy() is None:
+            logger.warning("Retrieval unavailable: NumPy is not installed")
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self.vectors_path = os.path.join(self.directory, 'vectors.f32')
+            self.seqs_path = os.path.join(self.directory, 'seqs.i64')
+            self.offsets_path = os.path.join(self.directory, 'offsets.i64')
+            self.texts_path = os.path.join(self.directory, 'texts.jsonl')
+            self.dim = int(self.embed(["dimension probe"]).shape[1])
+            self.open_files()
+            self.available = True
+        except Exception as e:
+            logger.warning("Retrieval index unavailable: %s", e)
+    
+    def open_files(self):
+        """Check the embedding matches and cut off a half-written last row"""
+        meta = {"embedding": getattr(self.embed, "__name__", repr(self.embed)), "dim": self.dim, "texts": True}
+        meta_path = os.path.join(self.directory, 'meta.json')
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            stored = None
+        paths = (self.vectors_path, self.seqs_path, self.offsets_path, self.texts_path)
+        if stored != meta:
+            for path in paths:
+                open(path, 'wb').close()
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+        
+        for path in paths:
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+        row_bytes = self.dim * 4
+        self.count = min(os.path.getsize(self.vectors_path) // row_bytes, os.path.getsize(self.seqs_path) // 8,
+                         os.path.getsize(self.offsets_path) // 8)
+        texts_size = 0
+        if self.count:
+            # Texts are written first, so everything up to the end of the last counted line is whole
+            offset = int(np.memmap(self.offsets_path, dtype=np.int64, mode='r', shape=(self.count,))[-1])
+            with open(self.texts_path, 'rb') as f:
+                f.seek(offset)
+                line = f.readline()
+            texts_size = offset + len(line) if line.endswith(b"\n") else 0
+            if not texts_size:
+                self.count = 0  # The texts were cut short; catch_up rebuilds the index
+        for path, size in ((self.vectors_path, self.count * row_bytes), (self.seqs_path, self.count * 8),
+                           (self.offsets_path, self.count * 8), (self.texts_path, texts_size)):
+            if os.path.getsize(path) != size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+        if self.count:
+            self.last_seq = int(np.memmap(self.seqs_path, dtype=np.int64, mode='r', shape=(self.count,))[-1])
+    
+    def add(self, *entries):
+        """Embed and append stored entries (they must already carry a seq)"""
+        rows = [entry for entry in entries if "seq" in entry and entry.get("content")]
+        if not self.available or not rows:
+            return
+        vectors = np.ascontiguousarray(self.embed([entry["content"] for entry in rows]), dtype=np.float32)
+        seqs = np.array([entry["seq"] for entry in rows], dtype=np.int64)
+        lines = [(json.dumps({"seq": entry["seq"], "type": entry.get("type", Role.ASSISTANT.value),
+                              "content": entry["content"]}, ensure_ascii=False) + "\n").encode("utf-8")
+                 for entry in rows]
+        with self.lock:
+            with open(self.texts_path, 'ab') as f:
+                start = f.tell()
+                f.write(b"".join(lines))
+            offsets = start + np.cumsum([0] + [len(line) for line in lines[:-1]], dtype=np.int64)
+            with open(self.offsets_path, 'ab') as f:
+                f.write(offsets.tobytes())
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self.seqs_path, 'ab') as f:
+                f.write(seqs.tobytes())
+            self.count += len(rows)
+            self.last_seq = max(self.last_seq, int(seqs.max()))
+            self.mapped = None
+    
+    def catch_up(self, history_store, batch_size=500):
+        """Embed journal entries written while the index was not updated"""
+        if not self.available:
+            return
+        start = self.last_seq + 1
+        while start < history_store.next_seq:
+            end = start + batch_size
+            self.add(*history_store.read_range(start, end))
+            start = end
+    
+    def search(self, text, limit=5):
+        """Return (seq, score) pairs for the stored messages most similar to ``text``, best first"""
+        if not self.available or not self.count or limit <= 0:
+            return []
+        query = np.asarray(self.embed([text])[0], dtype=np.float32)
+        vectors, seqs, offsets = self.map_files()
+        scores = vectors @ query
+        limit = min(limit, len(scores))
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return [(int(seqs[i]), float(scores[i])) for i in top]
+    
+    def messages(self, seqs):
+        """Return {seq: {"seq", "type", "content"}} for those of ``seqs`` that are in the index"""
+        if not self.available or not self.count or not seqs:
+            return {}
+        vectors, stored, offsets = self.map_files()
+        records = {}
+        with open(self.texts_path, 'rb') as f:
+            for row in np.flatnonzero(np.isin(stored, list(seqs))):
+                f.seek(int(offsets[row]))
+                record = json.loads(f.readline())
+                records[record["seq"]] = record
+        return records
+    
+    def map_files(self):
+        with self.lock:
+            if self.mapped is None:
+                self.mapped = (
+                    np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self.count, self.dim)),
+                    np.memmap(self.seqs_path, dtype=np.int64, mode='r', shape=(self.count,)),
+                    np.memmap(self.offsets_path, dtype=np.int64, mode='r', shape=(self.count,))
+                )
+            return self.mapped
+    
+    def clear(self):
+        if not self.available:
+            return
+        with self.lock:
+            self.mapped = None
+            for path in (self.vectors_path, self.seqs_path, self.offsets_path, self.texts_path):
+                open(path, 'wb').close()
+            self.count = 0
+            self.last_seq = -1
+    
+    def close(self):
+        with self.lock:
+            self.mapped = None
+
+
+class ResponseCache:
+    """On-disk LRU cache of model responses with a size cap and a TTL.
+
+    Keys are a hash of everything that shapes the answer: model, mode,
+    pinned context and the final prompt text. A database that can't be
+    opened leaves the cache unavailable, every lookup a miss.
+    """
+
+    def __init__(self, path='gemini_cache.db', max_bytes=20 * 1024 * 1024, ttl=7 * 24 * 3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.available = False
+        self.total_bytes = 0
+        try:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT, created REAL, last_used REAL, size INTEGER)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)")
+            self.conn.commit()
+            self.total_bytes = self.conn.execute("SELECT coalesce(sum(size), 0) FROM responses").fetchone()[0]
+            self.available = True
+        except sqlite3.Error as e:
+            logger.warning("Response cache unavailable: %s", e)
+            self.conn = None
+    
+    @staticmethod
+    def make_key(model, mode, pinned_context, prompt):
+        payload = json.dumps([model, mode, list(pinned_context), prompt], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        """Return the cached response, or None on a miss or an expired entry"""
+        if not self.available:
+            return None
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT response, created, size FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] > self.ttl:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= row[2]
+                row = None
+            if row is None:
+                self.misses += 1
+                self.conn.commit()
+                return None
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+            return row[0]
+    
+    def contains(self, key):
+        """Whether ``key`` has a live entry, without counting a lookup or touching it"""
+        if not self.available:
+            return False
+        with self.lock:
+            row = self.conn.execute("SELECT created FROM responses WHERE key = ?", (key,)).fetchone()
+        return row is not None and time.time() - row[0] <= self.ttl
+    
+    def put(self, key, response):
+        if not self.available:
+            return
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if old:
+                self.total_bytes -= old[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses(key, response, created, last_used, size) VALUES (?, ?, ?, ?, ?)",
+                (key, response, now, now, size)
+            )
+            self.total_bytes += size
+            self.evict()
+            self.conn.commit()
+    
+    def evict(self):
+        """Drop least recently used entries until the cache fits its size cap"""
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_used LIMIT 50"
+            ).fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            for key, size in rows:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+    
+    def stats(self):
+        entries = 0
+        if self.available:
+            with self.lock:
+                entries = self.conn.execute("SELECT count(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": self.total_bytes
+        }
+    
+    def clear(self):
+        if not self.available:
+            return
+        with self.lock:
+            self.conn.execute("DELETE FROM responses")
+            self.conn.commit()
+            self.total_bytes = 0
+    
+    def close(self):
+        if self.conn:
+            with self.lock:
+                self.conn.close()
+            self.conn = None
+            self.available = False
+
+
+PRIORITY_QUICK = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LONG = 2
+PRIORITY_BACKGROUND = 3
+
+
+class RequestScheduler:
+    """Bounded pool of worker threads running queued jobs by priority.
+
+    Lower priority numbers run first; jobs with equal priority run in
+    submission order.
+    """
+
+    def __init__(self, max_workers=3):
+        self.queue = queue.PriorityQueue()
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.workers = []
+        for i in range(max_workers):
+            worker = threading.Thread(target=self.worker_loop, name=f"gemini-worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+    
+    def submit(self, func, *args, priority=PRIORITY_NORMAL):
+        with self.lock:
+            self.queued += 1
+        self.queue.put((priority, next(self.order), func, args))
+    
+    def worker_loop(self):
+        while True:
+            priority, order, func, args = self.queue.get()
+            if func is None:
+                break
+            with self.lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                func(*args)
+            except Exception as e:
+                logger.exception("Error in scheduled request: %s", e)
+            finally:
+                with self.lock:
+                    self.active -= 1
+    
+    def in_flight(self):
+        """Number of jobs that are queued or running"""
+        with self.lock:
+            return self.queued + self.active
+    
+    def shutdown(self):
+        # Sentinels sort after every real job so queued work is drained first
+        for _ in self.workers:
+            self.queue.put((float('inf'), next(self.order), None, ()))
+
+
+class ModelBackend:
+    """Interface between the overlay and whatever produces replies.
+
+    ``stream`` yields the reply as text chunks; everything above it (the
+    scheduler, streaming display, cache and history) is backend agnostic.
+    """
+    name = "backend"
+    requires_api_key = True
+
+    def configure(self, api_key):
+        pass
+    
+    def is_configured(self):
+        return True
+    
+    def warm_up(self, model_ids):
+        pass
+    
+    def stream(self, model_id, prompt, system_instruction=None, usage=None):
+        """Yield reply text chunks; fill ``usage`` with prompt/response token counts if given"""
+        raise NotImplementedError
+    
+    def generate(self, model_id, prompt, system_instruction=None, usage=None):
+        return "".join(self.stream(model_id, prompt, system_instruction, usage))
+    
+    def close(self):
+        pass
+
+
+class GeminiBackend(ModelBackend):
+    """Google Gemini through google.generativeai.
+
+    Clients are pooled per (model id, system instruction). The mode prompt
+    and pinned context travel as a real ``system_instruction``; once they
+    are large enough for context caching they are uploaded once as a
+    ``CachedContent`` and reused until they change.
+    """
+    name = "gemini"
+
+    def __init__(self, cache_min_tokens=4096, cache_ttl=timedelta(hours=1), max_pooled=12):
+        self.cache_min_tokens = cache_min_tokens
+        self.cache_ttl = cache_ttl
+        self.max_pooled = max_pooled
+        # (model id, system hash) -> (GenerativeModel, CachedContent or None, cache expiry)
+        self.model_pool = collections.OrderedDict()
+        self.model_pool_lock = threading.Lock()
+        # Key -> lock held while that entry is built, so the slow cache upload
+        # happens once and outside model_pool_lock
+        self.building = {}
+        self.configured = False
+    
+    def configure(self, api_key):
+        load_genai().configure(api_key=api_key)
+        with self.model_pool_lock:
+            self.model_pool = collections.OrderedDict()
+        self.configured = True
+    
+    def is_configured(self):
+        return self.configured
+    
+    def get_model(self, model_id, system_instruction=None):
+        """Return the pooled client for a model and system instruction, creating it on first use"""
+        digest = hashlib.sha256(system_instruction.encode('utf-8')).hexdigest() if system_instruction else None
+        key = (model_id, digest)
+        with self.model_pool_lock:
+            model = self.pooled_model(key)
+            if model is not None:
+                return model
+            building = self.building.setdefault(key, threading.Lock())
+        
+        with building:
+            with self.model_pool_lock:
+                # Built by another thread while this one waited
+                model = self.pooled_model(key)
+                if model is not None:
+                    return model
+            
+            sdk = load_genai()
+            cached = None
+            if system_instruction and estimate_tokens(system_instruction) >= self.cache_min_tokens:
+                try:
+                    cached = sdk.caching.CachedContent.create(
+                        model=f"models/{model_id}",
+                        display_name="gemini-everywhere-context",
+                        system_instruction=system_instruction,
+                        ttl=self.cache_ttl
+                    )
+                    logger.info("📦 Cached %s context tokens for %s", estimate_tokens(system_instruction), model_id)
+                except Exception as e:
+                    logger.warning("Context caching unavailable for %s, sending it inline: %s", model_id, e)
+            if cached is not None:
+                model = sdk.GenerativeModel.from_cached_content(cached)
+            else:
+                model = sdk.GenerativeModel(model_id, system_instruction=system_instruction)
+            
+            with self.model_pool_lock:
+                # Retire what this entry replaces: its own expired cache and, when the
+                # pins or mode changed, any older cached context for the same model
+                retired = []
+                if key in self.model_pool:
+                    retired.append(self.model_pool.pop(key)[1])
+                if cached is not None:
+                    for old_key in [k for k, v in self.model_pool.items() if k[0] == model_id and v[1] is not None]:
+                        retired.append(self.model_pool.pop(old_key)[1])
+                self.model_pool[key] = (model, cached, time.time() + self.cache_ttl.total_seconds())
+                while len(self.model_pool) > self.max_pooled:
+                    retired.append(self.model_pool.popitem(last=False)[1][1])
+                self.building.pop(key, None)
+        
+        retired = [old for old in retired if old is not None]
+        if retired:
+            threading.Thread(target=self.delete_cached, args=(retired,), daemon=True).start()
+        return model
+    
+    def pooled_model(self, key):
+        """The pooled client for ``key`` if it is still usable; callers hold model_pool_lock"""
+        pooled = self.model_pool.get(key)
+        # Cached content expires server-side, so recreate it shortly before that happens
+        if pooled and (pooled[1] is None or pooled[2] > time.time() + 60):
+            self.model_pool.move_to_end(key)
+            return pooled[0]
+        return None
+    
+    def delete_cached(self, cached_contents):
+        for cached in cached_contents:
+            try:
+                cached.delete()
+            except Exception as e:
+                logger.warning("Error deleting cached context: %s", e)
+    
+    def close(self):
+        """Delete cached contexts now instead of paying for them until their TTL"""
+        with self.model_pool_lock:
+            cached = [entry[1] for entry in self.model_pool.values() if entry[1] is not None]
+            self.model_pool = collections.OrderedDict()
+        self.delete_cached(cached)
+    
+    def warm_up(self, model_ids):
+        """Create every model and open the connection before the first query"""
+        for model_id in model_ids:
+            try:
+                started = time.perf_counter()
+                # count_tokens is free and goes through the same channel as generate_content
+                self.get_model(model_id).count_tokens("ping")
+                logger.info("🔥 Warmed up %s in %.2fs", model_id, time.perf_counter() - started)
+            except Exception as e:
+                logger.warning("Warm-up failed for %s: %s", model_id, e)
+    
+    def stream(self, model_id, prompt, system_instruction=None, usage=None):
+        response = self.get_model(model_id, system_instruction).generate_content(prompt, stream=True)
+        streamed = False
+        for chunk in response:
+            text = self.get_chunk_text(chunk)
+            if text:
+                streamed = True
+                yield text
+        if not streamed:
+            # Nothing usable was streamed; .text raises with the block/finish reason
+            yield response.text
+        self.read_usage(response, usage)
+    
+    def generate(self, model_id, prompt, system_instruction=None, usage=None):
+        response = self.get_model(model_id, system_instruction).generate_content(prompt)
+        self.read_usage(response, usage)
+        return response.text
+    
+    def read_usage(self, response, usage):
+        if usage is None:
+            return
+        try:
+            metadata = response.usage_metadata
+            usage["prompt_tokens"] = metadata.prompt_token_count
+            usage["response_tokens"] = metadata.candidates_token_count
+            usage["cached_tokens"] = getattr(metadata, "cached_content_token_count", 0)
+        except AttributeError:
+            pass
+    
+    def get_chunk_text(self, chunk):
+        """Return the text of a streamed chunk, or an empty string for non-text chunks"""
+        try:
+            return chunk.text
+        except (ValueError, AttributeError):
+            # Chunks without text parts (e.g. safety or finish metadata) raise on .text
+            return ""
+
+
+class StubBackendError(Exception):
+    """Simulated API failure raised by StubBackend"""
+
+
+class StubBackend(ModelBackend):
+    """Local, deterministic stand-in for the Gemini API.
+
+    Replies come from ``script`` (a mapping of prompt substring to reply)
+    or are synthesized from the prompt. Latency, chunking and the error
+    rate are configurable and the random source is seeded, so runs are
+    repeatable offline. It mirrors Gemini context caching: a large system
+    instruction counts as uploaded only when it differs from the one
+    cached for that model, which makes ``bytes_uploaded`` a direct
+    measure of what caching saves.
+    """
+    name = "stub"
+    requires_api_key = False
+
+    def __init__(self, latency=0.3, chunk_size=24, chunk_delay=0.02, error_rate=0.0, script=None, seed=0,
+                 cache_min_tokens=4096):
+        self.latency = latency  # Seconds before the first chunk
+        self.chunk_size = chunk_size  # Characters per chunk
+        self.chunk_delay = chunk_delay  # Seconds between chunks
+        self.error_rate = error_rate
+        self.script = script or {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.cache_min_tokens = cache_min_tokens
+        self.cached_systems = {}  # model id -> hash of the cached system instruction
+        self.requests = 0
+        self.errors = 0
+        self.bytes_uploaded = 0
+        self.cache_creations = 0
+    
+    def reply_for(self, prompt):
+        for needle, reply in self.script.items():
+            if needle in prompt:
+                return reply
+        words = re.findall(r"\w+", prompt)[-12:]
+        body = " ".join(words) or "nothing"
+        return (f"Stub reply about: {body}.\n\n"
+                + "This is synthetic text from the local stub backend. " * 6).strip()
+    
+    def stream(self, model_id, prompt, system_instruction=None, usage=None):
+        with self.lock:
+            self.requests += 1
+            self.bytes_uploaded += len(str(prompt).encode('utf-8'))
+            if system_instruction:
+                digest = hashlib.sha256(system_instruction.encode('utf-8')).hexdigest()
+                cacheable = estimate_tokens(system_instruction) >= self.cache_min_tokens
+                if not cacheable or self.cached_systems.get(model_id) != digest:
+                    self.bytes_uploaded += len(system_instruction.encode('utf-8'))
+                if cacheable and self.cached_systems.get(model_id) != digest:
+                    self.cached_systems[model_id] = digest
+                    self.cache_creations += 1
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        time.sleep(self.latency)
+        if fail:
+            raise StubBackendError("503 Service Unavailable (simulated by stub backend)")
+        reply = self.reply_for(str(prompt))
+        for i in range(0, len(reply), self.chunk_size):
+            if i:
+                time.sleep(self.chunk_delay)
+            yield reply[i:i + self.chunk_size]
+        if usage is not None:
+            usage["prompt_tokens"] = estimate_tokens(str(prompt)) + estimate_tokens(system_instruction or "")
+            usage["response_tokens"] = estimate_tokens(reply)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "bytes_uploaded": self.bytes_uploaded,
+                "cache_creations": self.cache_creations
+            }
+
+
+def create_backend(name="gemini", **stub_options):
+    """Build the backend selected on the command line"""
+    if name == "stub":
+        return StubBackend(**stub_options)
+    return GeminiBackend()
+
+
+class OverlayBenchmark:
+    """Drives the real overlay with a burst of queries and reports latencies (--bench)"""
+
+    def __init__(self, app, count, interval=0.05, pinned_kb=0):
+        self.app = app
+        self.count = count
+        self.interval = interval
+        self.pinned_kb = pinned_kb  # Pin this much synthetic context to exercise context caching
+        self.sent = 0
+        self.results = []  # (queue+generation seconds, reply length)
+        self.max_stall = 0.0
+        self.started = None
+        self.last_beat = None
+    
+    def start(self):
+        if self.pinned_kb:
+            line = "Benchmark pinned reference material, repeated to reach the requested size.\n"
+            self.app.pinned_context.append(line * (self.pinned_kb * 1024 // len(line) + 1))
+        self.started = time.perf_counter()
+        self.last_beat = self.started
+        self.heartbeat()
+        self.send_next()
+    
+    def heartbeat(self):
+        """Measure how long the Tk event loop goes without servicing a 10 ms timer"""
+        now = time.perf_counter()
+        self.max_stall = max(self.max_stall, now - self.last_beat - 0.01)
+        self.last_beat = now
+        if len(self.results) < self.count:
+            self.app.window.after(10, self.heartbeat)
+    
+    def send_next(self):
+        if self.sent >= self.count:
+            return
+        self.sent += 1
+        self.app.query_entry.delete(0, 'end')
+        self.app.query_entry.insert(0, f"!Benchmark question {self.sent}: explain request scheduling")
+        self.app.send_query()
+        self.app.window.after(int(self.interval * 1000), self.send_next)
+    
+    def on_request_done(self, request, final_entry):
+        self.results.append((time.perf_counter() - request["enqueued"], len(final_entry.content)))
+        if len(self.results) >= self.count:
+            self.report()
+            self.app.window.after(200, self.app.window.quit)
+    
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        latencies = sorted(latency for latency, length in self.results)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"\n📊 Benchmark: {self.count} requests in {elapsed:.2f}s ({self.count / elapsed:.1f} req/s)")
+        print(f"   latency mean {sum(latencies) / len(latencies) * 1000:.0f} ms, "
+              f"p95 {p95 * 1000:.0f} ms, max {latencies[-1] * 1000:.0f} ms")
+        print(f"   longest UI stall {self.max_stall * 1000:.1f} ms")
+        if isinstance(self.app.backend, StubBackend):
+            print(f"   backend {self.app.backend.stats()}")
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token) used for prompt budgeting"""
+    return len(text) // 4 + 1
+
+
+def split_text(text, max_tokens):
+    """Split text into parts of about ``max_tokens``, preferring paragraph, then sentence, boundaries.
+
+    Returns (separator, part) pairs; joining ``separator + part`` for every
+    pair in order restores the layout, so processed parts can be
+    reassembled the same way.
+    """
+    max_chars = max_tokens * 4
+    pieces = []  # (separator, text) at paragraph/sentence granularity
+    for paragraph in re.split(r"\n\s*\n", text.strip()):
+        separator = "\n\n"
+        if len(paragraph) <= max_chars:
+            pieces.append((separator, paragraph))
+            continue
+        for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+            # Nothing left to split on, cut at the size limit
+            while len(sentence) > max_chars:
+                pieces.append((separator, sentence[:max_chars]))
+                sentence = sentence[max_chars:]
+                separator = ""
+            pieces.append((separator, sentence))
+            separator = " "
+    
+    parts = []
+    for separator, piece in pieces:
+        if parts and len(parts[-1][1]) + len(separator) + len(piece) <= max_chars:
+            parts[-1] = (parts[-1][0], parts[-1][1] + separator + piece)
+        else:
+            parts.append((separator if parts else "", piece))
+    return parts
+
+
+MARKDOWN_HEADING = re.compile(r"(#{1,3})[ \t]+(.*)")
+MARKDOWN_INLINE = re.compile(r"\*\*(.+?)\*\*|`([^`\n]+)`")
+
+
+def parse_markdown(text):
+    """Split markdown into ``(text, tags)`` segments for the chat display.
+
+    Handles ``#`` to ``###`` headings, ``**bold**``, ``inline code`` and fenced
+    code blocks. The markers are dropped; lines inside a fence are kept
+    verbatim, and a fence that is still open runs to the end of the text.
+    Segments are inserted together with their tags, so Tk places the tags
+    itself. Text without any markup comes back as one segment holding
+    ``text`` itself rather than a copy.
+    """
+    segments = []
+    pieces = []
+    current = ()
+    
+    def emit(piece, tags):
+        nonlocal current
+        if tags != current:
+            if pieces:
+                segments.append(("".join(pieces), current))
+                pieces.clear()
+            current = tags
+        pieces.append(piece)
+    
+    in_code = False
+    for line in text.splitlines(keepends=True):
+        if line.lstrip().startswith("```"):
+            in_code = not in_code
+            continue
+        if in_code:
+            emit(line, ("md_code_block",))
+            continue
+        
+        tags = ()
+        heading = MARKDOWN_HEADING.match(line)
+        if heading:
+            tags = (f"md_h{len(heading.group(1))}",)
+            line = heading.group(2) + line[heading.end():]
+        position = 0
+        for match in MARKDOWN_INLINE.finditer(line):
+            emit(line[position:match.start()], tags)
+            if match.group(1) is not None:
+                emit(match.group(1), tags + ("md_bold",))
+            else:
+                emit(match.group(2), tags + ("md_code",))
+            position = match.end()
+        emit(line[position:], tags)
+    if pieces:
+        segments.append(("".join(pieces), current))
+    if not segments or (len(segments) == 1 and not segments[0][1] and segments[0][0] == text):
+        return [(text, ())]
+    return segments
+
+
+class ConversationContext:
+    """Builds bounded multi-turn prompts from the chat history.
+
+    The newest exchanges that fit ``token_budget`` are sent verbatim;
+    older ones are folded into a running summary that is updated
+    incrementally (previous summary + newly evicted exchanges) and kept
+    on disk, so prompt size stays flat however long the chat runs.
+    """
+
+    def __init__(self, path=os.path.join('gemini_history', 'summary.json'), token_budget=6000, summary_words=250):
+        self.path = path
+        self.token_budget = token_budget
+        self.summary_words = summary_words
+        self.summary = ""
+        self.summarized_through = -1  # Highest seq folded into the summary
+        self.lock = threading.Lock()
+        self.updating = False
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                self.summary = state.get("summary", "")
+                self.summarized_through = state.get("through_seq", -1)
+        except Exception as e:
+            logger.warning("Error loading conversation summary: %s", e)
+    
+    def exchanges(self, history, max_entries=200):
+        """Finished (user, assistant) pairs, newest first, not yet covered by the summary"""
+        pairs = []
+        i = len(history) - 1
+        stop = max(len(history) - max_entries, 0)
+        while i > stop:
+            reply, question = history[i], history[i - 1]
+            if reply.seq is not None and reply.seq <= self.summarized_through:
+                break
+            if (reply.role is Role.ASSISTANT and question.role is Role.USER
+                    and reply.request_id is None and not reply.content.startswith("❌")
+                    and not question.content.startswith('/')):
+                pairs.append((question, reply))
+                i -= 2
+            else:
+                i -= 1
+        return pairs
+    
+    def build(self, history, prompt):
+        """Return (contents, evicted) for a new prompt given the history before it"""
+        with self.lock:
+            summary = self.summary
+        budget = self.token_budget - estimate_tokens(prompt) - estimate_tokens(summary)
+        recent, evicted = [], []
+        for question, reply in self.exchanges(history):
+            cost = estimate_tokens(question.content) + estimate_tokens(reply.content)
+            if not evicted and cost <= budget:
+                recent.append((question, reply))
+                budget -= cost
+            else:
+                evicted.append((question, reply))
+        
+        contents = []
+        if summary:
+            contents.append({"role": "user", "parts": [f"Summary of our earlier conversation:\n{summary}"]})
+            contents.append({"role": "model", "parts": ["Got it, I'll keep that in mind."]})
+        for question, reply in reversed(recent):
+            contents.append({"role": "user", "parts": [question.content]})
+            contents.append({"role": "model", "parts": [reply.content]})
+        contents.append({"role": "user", "parts": [prompt]})
+        return contents, evicted[::-1]
+    
+    def update(self, evicted, backend, model_id):
+        """Fold evicted exchanges into the running summary with one model call"""
+        evicted = [(question, reply) for question, reply in evicted if reply.seq is not None]
+        with self.lock:
+            if self.updating:
+                return
+            evicted = [pair for pair in evicted if pair[1].seq > self.summarized_through]
+            if not evicted:
+                return
+            self.updating = True
+            summary = self.summary
+        try:
+            transcript = "\n\n".join(
+                f"User: {question.content[:2000]}\nAssistant: {reply.content[:2000]}"
+                for question, reply in evicted
+            )
+            prompt = (f"Update the running summary of a conversation with the new exchanges below. "
+                      f"Keep every fact, decision and open question that later questions may refer to, "
+                      f"in at most {self.summary_words} words. Reply with the summary only.\n\n"
+                      f"Current summary:\n{summary or '(empty)'}\n\nNew exchanges:\n{transcript}")
+            new_summary = backend.generate(model_id, prompt).strip()
+            with self.lock:
+                self.summary = new_summary
+                self.summarized_through = max(reply.seq for question, reply in evicted)
+                state = {"summary": self.summary, "through_seq": self.summarized_through}
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+        finally:
+            with self.lock:
+                self.updating = False
+    
+    def reset(self):
+        with self.lock:
+            self.summary = ""
+            self.summarized_through = -1
+        try:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        except OSError as e:
+            logger.warning("Error removing conversation summary: %s", e)
+
+
+class Session:
+    """A named conversation and, once opened, its history stores"""
+
+    def __init__(self, name, directory):
+        self.name = name
+        self.directory = directory
+        self.history_store = None
+        self.search_index = None
+        self.conversation = None
+        self.vector_index = None
+        self.messages = None  # chat_history as it was when the user switched away
+        self.busy = 0  # Background jobs using the stores; the session isn't closed while any run
+    
+    def open(self, token_budget, embed=None):
+        if embed is not None and self.vector_index is None:
+            self.vector_index = VectorIndex(os.path.join(self.directory, 'vectors'), embed)
+        if self.history_store is None:
+            # Only the original directory imports the pre-journal gemini_history.json
+            legacy_file = 'gemini_history.json' if self.directory == 'gemini_history' else None
+            self.history_store = HistoryStore(self.directory, legacy_file=legacy_file)
+            self.search_index = SearchIndex(os.path.join(self.directory, 'search.db'))
+            self.conversation = ConversationContext(os.path.join(self.directory, 'summary.json'),
+                                                    token_budget=token_budget)
+    
+    def close(self):
+        if self.history_store is not None:
+            self.history_store.close()
+            self.search_index.close()
+        if self.vector_index is not None:
+            self.vector_index.close()
+        self.history_store = None
+        self.search_index = None
+        self.conversation = None
+        self.vector_index = None
+        self.messages = None
+
+
+class SessionManager:
+    """Index of named conversations, each kept in its own history directory.
+
+    Only the small index file (names, directories and each session's mode,
+    model and pinned context) is read at startup. A session's journal,
+    search index and summary are opened the first time it is switched to,
+    and the least recently used sessions are closed again, messages and all,
+    once more than ``max_open`` are open; a session still held through
+    ``in_use`` is left open until a later switch. The "Default" session keeps
+    using the original gemini_history directory.
+    """
+
+    DEFAULT = "Default"
+
+    def __init__(self, path='gemini_sessions.json', root='gemini_sessions', max_open=3):
+        self.path = path
+        self.root = root
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.active = self.DEFAULT
+        self.sessions = {self.DEFAULT: {"directory": 'gemini_history'}}
+        self.open_sessions = collections.OrderedDict()  # Name -> Session, least recently used first
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                self.sessions.update(state.get("sessions", {}))
+                if state.get("active") in self.sessions:
+                    self.active = state["active"]
+        except Exception as e:
+            logger.warning("Error loading session index: %s", e)
+    
+    def names(self):
+        return list(self.sessions)
+    
+    def settings(self, name):
+        return self.sessions[name]
+    
+    def create(self, name, **settings):
+        """Add an empty session with its own directory"""
+        with self.lock:
+            if name in self.sessions:
+                raise ValueError(f"Session {name!r} already exists")
+            slug = re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-') or "session"
+            taken = {entry.get("directory") for entry in self.sessions.values()}
+            directory = os.path.join(self.root, slug)
+            for n in itertools.count(2):
+                if directory not in taken and not os.path.exists(directory):
+                    break
+                directory = os.path.join(self.root, f"{slug}-{n}")
+            self.sessions[name] = dict(settings, directory=directory)
+            self.save()
+    
+    def update(self, name, **settings):
+        with self.lock:
+            self.sessions[name].update(settings)
+            self.save()
+    
+    def open(self, name, token_budget, embed=None):
+        """Make ``name`` the active session, opening its stores (and vector index, given ``embed``) if needed"""
+        with self.lock:
+            session = self.open_sessions.pop(name, None) or Session(name, self.sessions[name]["directory"])
+            session.open(token_budget, embed)
+            self.open_sessions[name] = session
+            idle = [other for other, open_session in self.open_sessions.items()
+                    if other != name and not open_session.busy]
+            for evicted_name in idle[:len(self.open_sessions) - self.max_open]:
+                self.open_sessions.pop(evicted_name).close()
+                logger.debug("Closed idle session %s", evicted_name)
+            self.active = name
+            self.save()
+            return session
+    
+    @contextmanager
+    def in_use(self, session):
+        """Keep ``session`` from being closed by eviction while a background job uses its stores"""
+        with self.lock:
+            session.busy += 1
+        try:
+            yield session
+        finally:
+            with self.lock:
+                session.busy -= 1
+    
+    def save(self):
+        """Write the index; callers hold the lock"""
+        try:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({"active": self.active, "sessions": self.sessions}, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.error("Error saving session index: %s", e)
+    
+    def close(self):
+        with self.lock:
+            for session in self.open_sessions.values():
+                session.close()
+            self.open_sessions.clear()
+
+
+class Histogram:
+    """Rolling window of samples summarized as percentiles"""
+
+    def __init__(self, window=2000):
+        self.samples = collections.deque(maxlen=window)
+        self.times = collections.deque(maxlen=window)  # time.monotonic() of each sample
+        self.count = 0
+        self.total = 0.0
+    
+    def observe(self, value):
+        self.samples.append(value)
+        self.times.append(time.monotonic())
+        self.count += 1
+        self.total += value
+    
+    def recent(self, max_age=None):
+        """Samples, or only those observed in the last ``max_age`` seconds"""
+        if max_age is None:
+            return list(self.samples)
+        cutoff = time.monotonic() - max_age
+        return [value for value, observed in zip(self.samples, self.times) if observed >= cutoff]
+    
+    def percentiles(self, *quantiles):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return [0.0 for _ in quantiles]
+        return [ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in quantiles]
+
+
+class MetricsRegistry:
+    """Per-request latency and token metrics with a Prometheus text export.
+
+    Histograms and counters are keyed by metric name plus a sorted tuple
+    of labels. The export is written atomically to ``path`` at most every
+    ``export_interval`` seconds and can also be served over HTTP.
+    """
+    QUANTILES = (0.5, 0.95, 0.99)
+    
+    HELP = {
+        "gemini_request_queue_seconds": "Time from Send until a worker picked the request up",
+        "gemini_request_first_chunk_seconds": "Time from the API call (after rate limit and retry waits) to the first streamed chunk",
+        "gemini_request_total_seconds": "Time from the API call (after rate limit and retry waits) until the reply was complete",
+        "gemini_requests_total": "Finished requests",
+        "gemini_tokens_total": "Prompt and response tokens",
+        "gemini_rate_limit_wait_seconds": "Time a request was held back by the client-side rate limiter",
+        "gemini_retries_total": "Requests retried after a transient error",
+        "gemini_fallbacks_total": "Requests answered by a fallback model",
+        "gemini_hedges_total": "Backup requests sent because the first chunk was late, by whether they won",
+        "gemini_hotkey_to_focus_seconds": "Time from the Ctrl+Space press until the input had keyboard focus",
+        "gemini_speculations_total": "Speculative quick-command requests, by whether the sent query adopted them",
+        "gemini_speculation_seconds_total": "Latency saved by adopted and spent on discarded speculative requests",
+    }
+
+    def __init__(self, path='gemini_metrics.prom', export_interval=5.0):
+        self.path = path
+        self.export_interval = export_interval
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.recent = collections.deque(maxlen=200)  # Raw per-request records for the stats panel
+        self.last_export = 0.0
+    
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+    
+    def observe(self, name, value, **labels):
+        with self.lock:
+            key = self.key(name, labels)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+    
+    def inc(self, name, amount=1, **labels):
+        with self.lock:
+            key = self.key(name, labels)
+            self.counters[key] = self.counters.get(key, 0) + amount
+    
+    def record_request(self, record):
+        """Roll one finished request (see get_gemini_response) into the metrics"""
+        labels = {"model": record["model"], "mode": record["mode"]}
+        self.observe("gemini_request_queue_seconds", record.get("started", record["sent"]) - record["enqueued"], **labels)
+        if not record["cache_hit"] and record["status"] == "ok":
+            self.observe("gemini_request_first_chunk_seconds", record["first_chunk"] - record["sent"], **labels)
+            self.observe("gemini_request_total_seconds", record["done"] - record["sent"], **labels)
+        self.inc("gemini_requests_total", status=record["status"],
+                 cache="hit" if record["cache_hit"] else "miss", **labels)
+        self.inc("gemini_tokens_total", record["prompt_tokens"], kind="prompt", model=record["model"])
+        self.inc("gemini_tokens_total", record["response_tokens"], kind="response", model=record["model"])
+        with self.lock:
+            self.recent.append(record)
+        if time.time() - self.last_export >= self.export_interval:
+            self.export()
+    
+    def prometheus_text(self):
+        """Render everything in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        
+        described = set()
+        for (name, labels), histogram in histograms:
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {self.HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} summary")
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+            for q, value in zip(self.QUANTILES, histogram.percentiles(*self.QUANTILES)):
+                lines.append(f'{name}{{{label_text},quantile="{q}"}} {value:.6f}')
+            lines.append(f"{name}_sum{{{label_text}}} {histogram.total:.6f}")
+            lines.append(f"{name}_count{{{label_text}}} {histogram.count}")
+        for (name, labels), value in counters:
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {self.HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"{name}{{{label_text}}} {value}")
+        return "\n".join(lines) + "\n"
+    
+    def export(self):
+        """Write the Prometheus text file atomically"""
+        self.last_export = time.time()
+        try:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(self.prometheus_text())
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.warning("Error exporting metrics: %s", e)
+    
+    def serve(self, port):
+        """Serve /metrics on localhost in a daemon thread"""
+        registry = self
+        
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info("📈 Metrics served at http://127.0.0.1:%s/metrics", port)
+        return server
+    
+    def percentile(self, name, quantile, min_samples=1, max_age=None, **labels):
+        """Percentile across every series of ``name`` carrying ``labels``, or None with too few samples.
+        
+        With ``max_age`` only samples from the last that many seconds count,
+        so a policy acting on the result can recover once a slow spell ends.
+        """
+        wanted = set(labels.items())
+        with self.lock:
+            samples = sorted(value for (series, series_labels), histogram in self.histograms.items()
+                             if series == name and wanted <= set(series_labels)
+                             for value in histogram.recent(max_age))
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(quantile * len(samples)))]
+    
+    def summary_rows(self):
+        """(model, mode, requests, cache hit %, first chunk p50/p95/p99, total p50/p95/p99, tokens in/out)"""
+        groups = {}
+        with self.lock:
+            records = list(self.recent)
+        for record in records:
+            groups.setdefault((record["model"], record["mode"]), []).append(record)
+        
+        rows = []
+        for (model, mode), group in sorted(groups.items()):
+            first_chunk, total = Histogram(), Histogram()
+            for record in group:
+                if not record["cache_hit"] and record["status"] == "ok":
+                    first_chunk.observe(record["first_chunk"] - record["sent"])
+                    total.observe(record["done"] - record["sent"])
+            hits = sum(1 for record in group if record["cache_hit"])
+            rows.append((
+                model, mode, len(group), hits / len(group),
+                first_chunk.percentiles(*self.QUANTILES), total.percentiles(*self.QUANTILES),
+                sum(record["prompt_tokens"] for record in group),
+                sum(record["response_tokens"] for record in group)
+            ))
+        return rows
+
+
+class RateLimiter:
+    """Client-side per-model requests-per-minute and tokens-per-minute budgets.
+
+    Each model has two continuously refilled token buckets, one counting
+    requests and one counting (estimated) prompt tokens. ``reserve`` takes
+    from both straight away, letting the balance go negative, and returns
+    how long the caller has to wait before sending, so concurrent workers
+    line up behind each other instead of all retrying at once. A limit of
+    0 or None means unlimited; models without limits are never held back.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = {}  # model id -> (requests per minute, tokens per minute)
+        self.buckets = {}  # model id -> [requests left, tokens left, last refill]
+        self.lock = threading.Lock()
+        for model_id, (rpm, tpm) in (limits or {}).items():
+            self.set_limit(model_id, rpm, tpm)
+    
+    def set_limit(self, model_id, rpm, tpm):
+        with self.lock:
+            self.limits[model_id] = (rpm or 0, tpm or 0)
+            self.buckets.pop(model_id, None)
+    
+    def refill(self, model_id, now):
+        rpm, tpm = self.limits[model_id]
+        bucket = self.buckets.get(model_id)
+        if bucket is None:
+            bucket = self.buckets[model_id] = [rpm or float('inf'), tpm or float('inf'), now]
+        elapsed = now - bucket[2]
+        if rpm:
+            bucket[0] = min(rpm, bucket[0] + elapsed * rpm / 60)
+        if tpm:
+            bucket[1] = min(tpm, bucket[1] + elapsed * tpm / 60)
+        bucket[2] = now
+        return bucket
+    
+    def delay_for(self, model_id, bucket, tokens):
+        rpm, tpm = self.limits[model_id]
+        delay = 0.0
+        if rpm:
+            delay = max(delay, (1 - bucket[0]) * 60 / rpm)
+        if tpm:
+            # A prompt larger than the whole per-minute budget still goes out once the bucket is full
+            delay = max(delay, (min(tokens, tpm) - bucket[1]) * 60 / tpm)
+        return delay
+    
+    def estimate(self, model_id, tokens=0):
+        """Seconds a request of ``tokens`` would wait right now, without reserving anything"""
+        with self.lock:
+            if model_id not in self.limits:
+                return 0.0
+            return self.delay_for(model_id, self.refill(model_id, time.monotonic()), tokens)
+    
+    def reserve(self, model_id, tokens=0):
+        """Claim budget for one request and return how many seconds to wait before sending it"""
+        with self.lock:
+            if model_id not in self.limits:
+                return 0.0
+            bucket = self.refill(model_id, time.monotonic())
+            delay = self.delay_for(model_id, bucket, tokens)
+            bucket[0] -= 1
+            bucket[1] -= min(tokens, self.limits[model_id][1] or tokens)
+            return delay
+
+
+# Model selector entry that lets route_model pick per request
+AUTO_MODEL = "auto"
+
+# Free tier quotas (requests, tokens per minute), applied with --free-tier; none are applied by default
+FREE_TIER_RATE_LIMITS = {
+    "gemini-2.5-flash": (10, 250000),
+    "gemini-2.5-pro": (5, 250000)
+}
+
+# Exception class names (google.api_core and friends) worth retrying
+TRANSIENT_ERRORS = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+                    "DeadlineExceeded", "GatewayTimeout", "Aborted", "Unknown"}
+THROTTLE_ERRORS = {"ResourceExhausted", "TooManyRequests"}
+
+
+def is_throttle_error(error):
+    """True for quota and rate-limit errors (HTTP 429)"""
+    return type(error).__name__ in THROTTLE_ERRORS or "429" in str(error)
+
+
+def is_transient_error(error):
+    """True for errors that may succeed on retry: throttling, 5xx, timeouts and dropped connections"""
+    if isinstance(error, (TimeoutError, ConnectionError)) or is_throttle_error(error):
+        return True
+    if type(error).__name__ in TRANSIENT_ERRORS:
+        return True
+    return bool(re.match(r"(500|502|503|504)\b", str(error)))
+
+
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    """Exponential backoff with full jitter for retry number ``attempt`` (1-based)"""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class HedgedStream:
+    """Races a reply stream against a backup started when the first chunk is late.
+
+    ``start_primary`` and ``start_backup`` return chunk iterators
+    (``start_backup`` may return None to decline). Each is pumped by its
+    own thread into a shared queue. If the primary has produced nothing
+    after ``deadline`` seconds the backup is started; whichever yields a
+    chunk first wins and the other is cancelled. ``winner`` is 0 or 1 once
+    decided and ``hedged`` tells whether a backup was actually sent.
+    """
+
+    def __init__(self, start_primary, start_backup, deadline):
+        self.starters = (start_primary, start_backup)
+        self.deadline = deadline
+        self.events = queue.Queue()
+        self.cancelled = [False, False]
+        self.winner = None
+        self.hedged = False
+    
+    def pump(self, index):
+        stream = None
+        try:
+            stream = self.starters[index]()
+            if stream is None:
+                self.events.put((index, "declined", None))
+                return
+            if index == 1:
+                self.hedged = True
+            for text in stream:
+                if self.cancelled[index]:
+                    break
+                self.events.put((index, "chunk", text))
+            else:
+                self.events.put((index, "done", None))
+        except Exception as e:
+            self.events.put((index, "error", e))
+        finally:
+            close = getattr(stream, "close", None)
+            if close:
+                close()
+    
+    def launch(self, index):
+        threading.Thread(target=self.pump, args=(index,), name=f"hedge-{index}", daemon=True).start()
+    
+    def __iter__(self):
+        self.launch(0)
+        started = time.monotonic()
+        backup_launched = False
+        running = 1
+        error = None
+        try:
+            while True:
+                timeout = None
+                if not backup_launched and self.winner is None:
+                    timeout = max(0.0, self.deadline - (time.monotonic() - started))
+                try:
+                    index, kind, value = self.events.get(timeout=timeout)
+                except queue.Empty:
+                    backup_launched = True
+                    running += 1
+                    self.launch(1)
+                    continue
+                if self.winner is not None and index != self.winner:
+                    continue  # Leftovers from the cancelled stream
+                if kind == "chunk":
+                    if self.winner is None:
+                        self.winner = index
+                        self.cancelled[1 - index] = True
+                    yield value
+                elif kind == "done":
+                    if self.winner is None:
+                        self.winner = index
+                        self.cancelled[1 - index] = True
+                    return
+                elif self.winner is not None:
+                    raise value  # The winning stream failed part way through
+                else:
+                    # One side failed or declined before either produced text; wait for the other
+                    error = value if kind == "error" else error
+                    running -= 1
+                    if running == 0 or (not backup_launched and kind == "error"):
+                        raise error
+        finally:
+            # Stop anything still running: the loser, or both if the caller stopped reading
+            self.cancelled = [True, True]
+
+
+class BatchRunner:
+    """Runs a JSONL file of prompts through the overlay's modes and quick commands without a window.
+
+    Each input line is a JSON object with the prompt under ``prompt_field``
+    and optional ``id_field``, "mode" and "model" keys (a bare JSON string
+    is taken as the prompt). Results are appended to ``output_path`` as
+    they finish, one JSON object per line. Ids already answered in the
+    output are skipped, so an interrupted run resumes where it stopped.
+    A line that isn't valid JSON or has no prompt gets an error result
+    naming the line instead of stopping the run.
+    """
+
+    def __init__(self, app, input_path, output_path, parallel=4, prompt_field="prompt", id_field="id",
+                 mode=None, model=None):
+        self.app = app
+        self.input_path = input_path
+        self.output_path = output_path
+        self.parallel = parallel
+        self.prompt_field = prompt_field
+        self.id_field = id_field
+        self.mode = mode
+        self.model = model
+        self.results = queue.Queue()
+    
+    def load_done(self):
+        """Ids with a successful result already in the output file"""
+        done = set()
+        if not os.path.exists(self.output_path):
+            return done
+        with open(self.output_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Torn last line from an interrupted run
+                if record.get("status") == "ok":
+                    done.add(str(record["id"]))
+        return done
+    
+    def load_jobs(self, done):
+        """Pending jobs in input order; bad lines become jobs carrying an "error" instead of a prompt"""
+        jobs = []
+        with open(self.input_path, 'r', encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError as e:
+                    item, error = {}, f"line {number}: invalid JSON ({e})"
+                else:
+                    if not isinstance(item, dict):
+                        item = {self.prompt_field: item}
+                    prompt = item.get(self.prompt_field)
+                    error = None if prompt not in (None, "") else f"line {number}: no {self.prompt_field!r} field"
+                job = {
+                    "id": str(item.get(self.id_field, f"line-{number}")),
+                    "line": number,
+                    "prompt": str(item.get(self.prompt_field, "")),
+                    "mode": item.get("mode") or self.mode or self.app.current_mode,
+                    "model": item.get("model") or self.model or self.app.current_model
+                }
+                if error:
+                    job["error"] = error
+                if job["id"] not in done:
+                    jobs.append(job)
+        return jobs
+    
+    def run_job(self, job):
+        """Worker: answer one prompt and hand the result record to the writer"""
+        app = self.app
+        query = job["prompt"]
+        record = {"id": job["id"], "prompt": query, "mode": job["mode"]}
+        started = time.perf_counter()
+        first_chunk = None
+        usage = {}
+        
+        def on_chunk(text):
+            nonlocal first_chunk
+            if first_chunk is None:
+                first_chunk = time.perf_counter()
+        
+        model_id = job["model"]
+        content = ""
+        try:
+            content, model_id, note = app.answer_query(job["id"], query, job["mode"], model_id, usage, on_chunk)
+            record.update(status="ok", model=model_id, response=content)
+            if note:
+                record["note"] = note
+        except Exception as e:
+            record.update(status="error", model=model_id, error=str(e))
+        done = time.perf_counter()
+        record["first_chunk_seconds"] = round((first_chunk or done) - started, 3)
+        record["total_seconds"] = round(done - started, 3)
+        record["prompt_tokens"] = usage.get("prompt_tokens", estimate_tokens(query))
+        record["response_tokens"] = usage.get("response_tokens", estimate_tokens(content))
+        app.metrics.record_request({
+            "id": job["id"],
+            "model": model_id,
+            "mode": job["mode"],
+            "enqueued": started,
+            "sent": usage.get("sent", started),
+            "first_chunk": first_chunk or done,
+            "done": done,
+            "cache_hit": False,
+            "status": record["status"],
+            "prompt_tokens": record["prompt_tokens"],
+            "response_tokens": record["response_tokens"]
+        })
+        self.results.put(record)
+    
+    def run(self):
+        """Process every pending prompt and return the number that failed"""
+        jobs = self.load_jobs(self.load_done())
+        self.app.backend_ready.wait()
+        if not self.app.backend.is_configured():
+            raise RuntimeError(f"{self.app.backend.name} backend is not configured (set GEMINI_API_KEY)")
+        logger.info("📦 Batch: %d prompts to run with %d workers -> %s", len(jobs), self.parallel, self.output_path)
+        
+        scheduler = RequestScheduler(self.parallel)
+        for job in jobs:
+            if "error" in job:
+                self.results.put({"id": job["id"], "line": job["line"], "prompt": job["prompt"], "mode": job["mode"],
+                                  "status": "error", "model": job["model"], "error": job["error"],
+                                  "first_chunk_seconds": 0.0, "total_seconds": 0.0,
+                                  "prompt_tokens": 0, "response_tokens": 0})
+            else:
+                scheduler.submit(self.run_job, job)
+        
+        started = time.perf_counter()
+        records = []
+        try:
+            with open(self.output_path, 'a', encoding='utf-8') as output:
+                finished = 0
+                while finished < len(jobs):
+                    try:
+                        record = self.results.get(timeout=0.5)  # Wake up regularly so Ctrl+C gets through
+                    except queue.Empty:
+                        continue
+                    finished += 1
+                    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    output.flush()
+                    records.append(record)
+                    if record["status"] != "ok":
+                        logger.warning("Batch prompt %s failed: %s", record["id"], record["error"])
+                    logger.info("📦 %d/%d done (%s)", finished, len(jobs), record["id"])
+        finally:
+            scheduler.shutdown()
+            self.report(records, time.perf_counter() - started)
+        return sum(1 for record in records if record["status"] != "ok")
+    
+    def report(self, records, elapsed):
+        ok = [record for record in records if record["status"] == "ok"]
+        latency = Histogram()
+        for record in ok:
+            latency.observe(record["total_seconds"])
+        p50, p95 = latency.percentiles(0.5, 0.95)
+        tokens = sum(record["prompt_tokens"] + record["response_tokens"] for record in records)
+        elapsed = max(elapsed, 1e-9)
+        print(f"\n📦 Batch: {len(records)} prompts in {elapsed:.1f}s ({len(records) / elapsed:.2f} prompts/s, "
+              f"{tokens / elapsed:.0f} tokens/s)")
+        print(f"   {len(ok)} ok, {len(records) - len(ok)} failed; latency p50 {p50:.2f}s, p95 {p95:.2f}s")
+
+
+class IPCServer:
+    """Localhost HTTP API that lets scripts and editors use the running overlay.
+
+    Binds 127.0.0.1 on a free port and writes the port and a random token
+    to ``path``; every call must send the token in the X-Gemini-Token
+    header. Endpoints:
+        GET  /health             -> {"pid": ...}
+        POST /show               -> shows the overlay
+        POST /query              -> {"query", "mode", "model", "stream"}; the reply as JSON,
+                                    or one JSON object per line while streaming
+        GET  /history?limit=N    -> stored conversation entries, oldest first
+    Queries run on the app's request scheduler and are not added to the chat.
+    """
+
+    def __init__(self, app, path='gemini_ipc.json', port=0):
+        self.app = app
+        self.path = path
+        self.port = port
+        self.token = secrets.token_hex(16)
+        self.server = None
+    
+    def start(self):
+        ipc = self
+        
+        class IPCHandler(http.server.BaseHTTPRequestHandler):
+            def authorized(self):
+                if secrets.compare_digest(self.headers.get("X-Gemini-Token", ""), ipc.token):
+                    return True
+                self.send_error(403)
+                return False
+            
+            def send_json(self, payload, status=200):
+                body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def do_GET(self):
+                if not self.authorized():
+                    return
+                url = urllib.parse.urlparse(self.path)
+                if url.path == '/health':
+                    self.send_json({"pid": os.getpid()})
+                elif url.path == '/history':
+                    params = urllib.parse.parse_qs(url.query)
+                    try:
+                        limit = int(params.get("limit", ["50"])[0])
+                    except ValueError:
+                        self.send_error(400, "limit must be an integer")
+                        return
+                    self.send_json({"entries": ipc.history(limit)})
+                else:
+                    self.send_error(404)
+            
+            def do_POST(self):
+                if not self.authorized():
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    self.send_error(400, "invalid Content-Length")
+                    return
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except json.JSONDecodeError:
+                    self.send_error(400, "invalid JSON")
+                    return
+                if self.path == '/show':
+                    ipc.app.window.after(0, ipc.app.show_window)
+                    self.send_json({"shown": True})
+                elif self.path == '/query':
+                    if not str(body.get("query", "")).strip():
+                        self.send_error(400, "missing query")
+                        return
+                    ipc.query(self, body)
+                else:
+                    self.send_error(404)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', self.port), IPCHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="ipc-http", daemon=True).start()
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump({"pid": os.getpid(), "port": self.server.server_address[1], "token": self.token}, f)
+        logger.info("🔌 IPC API listening on 127.0.0.1:%s", self.server.server_address[1])
+    
+    def history(self, limit):
+        if not self.app.history_ready.wait(timeout=10) or not self.app.history_store:
+            return []
+        return self.app.history_store.tail(max(1, min(limit, 10000)))
+    
+    def query(self, handler, body):
+        """Answer a /query call, streaming chunks as NDJSON lines if asked to"""
+        app = self.app
+        stream = bool(body.get("stream"))
+        events = queue.Queue()
+        request_id = f"ipc-{next(app.request_ids)}"
+        
+        def job():
+            usage = {}
+            try:
+                # Like a batch run, don't race an instance that is still configuring its backend
+                app.backend_ready.wait()
+                if not app.backend.is_configured():
+                    raise RuntimeError(f"{app.backend.name} backend is not configured (set GEMINI_API_KEY)")
+                content, model_id, note = app.answer_query(
+                    request_id, str(body["query"]).strip(), body.get("mode") or app.current_mode,
+                    body.get("model") or app.current_model, usage,
+                    lambda text: events.put({"text": text}) if stream else None
+                )
+                events.put({"done": True, "status": "ok", "response": content, "model": model_id, "note": note})
+            except Exception as e:
+                events.put({"done": True, "status": "error", "error": str(e)})
+        
+        app.scheduler.submit(job, priority=PRIORITY_QUICK if str(body["query"]).startswith('/') else PRIORITY_NORMAL)
+        if not stream:
+            reply = events.get()
+            handler.send_json(reply, 200 if reply["status"] == "ok" else 502)
+            return
+        
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/x-ndjson")
+        handler.end_headers()
+        while True:
+            event = events.get()
+            if event.get("done"):
+                event.pop("response", None)  # Already streamed
+            try:
+                handler.wfile.write((json.dumps(event, ensure_ascii=False) + "\n").encode('utf-8'))
+                handler.wfile.flush()
+            except OSError:
+                return  # Client went away; the job finishes on its own
+            if event.get("done"):
+                return
+    
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def find_running_instance(path='gemini_ipc.json'):
+    """Connection details of a live overlay process, or None"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        response = ipc_request(info, "GET", "/health", timeout=1.0)
+        # The port may have been reused by something else since the file was written
+        if response.status != 200 or json.loads(response.read()).get("pid") != info["pid"]:
+            return None
+        return info
+    except (OSError, ValueError, KeyError, AttributeError, http.client.HTTPException):
+        return None
+
+
+def ipc_request(info, method, path, payload=None, timeout=None):
+    """Call a running instance's IPC API; returns the open response for JSON or NDJSON reading"""
+    connection = http.client.HTTPConnection('127.0.0.1', info["port"], timeout=timeout)
+    body = json.dumps(payload).encode('utf-8') if payload is not None else None
+    connection.request(method, path, body=body, headers={"X-Gemini-Token": info["token"],
+                                                          "Content-Type": "application/json"})
+    response = connection.getresponse()
+    if response.status == 403:
+        raise ValueError("IPC token rejected")
+    return response
+
 
 class GeminiEverywhere:
-    def __init__(self):
-        # Configure CustomTkinter
-        ctk.set_appearance_mode("dark")
-        ctk.set_default_color_theme("blue")
+    def __init__(self, startup_profile=False, backend=None, bench=0, bench_pinned_kb=0, rate_limits=None,
+                 model_fallback=True, headless=False, speculate=False, display_mode="standby", ipc=True,
+                 retrieval=False, hedge=False):
+        self.profiler = StartupProfiler(startup_profile)
+        self.backend = backend or GeminiBackend()
+        self.benchmark = OverlayBenchmark(self, bench, pinned_kb=bench_pinned_kb) if bench else None
         
         # Initialize variables
+        self.headless = headless  # Batch mode: no window and no hotkey
+        self.display_mode = display_mode  # "standby" keeps the hidden window laid out; "classic" re-raises on every show
+        self.hotkey_pressed_at = None  # Set by the hotkey thread, cleared when the input gets focus
         self.window = None
         self.is_visible = False
         self.chat_history = []
@@ -24,33 +2392,274 @@ class GeminiEverywhere:
         self.current_mode = "Normal"  # Default mode
         self.current_model = "gemini-2.5-flash"  # Default model
         self.pinned_context = []  # For context pinning
+        self.stream_responses = True  # Show replies as they are generated
+        self._stream_refresh_pending = False
+        self._rendered = []  # (entry, content, mode, note) already in chat_display
+        # Big replies are inserted a slice at a time from the Tk event loop
+        self.render_chunk_size = 8000  # Characters per insert
+        self.render_slice_budget = 0.008  # Seconds of work per slice
+        self._render_jobs = {}  # Mark number -> token of the latest render of that entry
+        # Only a window of the conversation is kept in chat_history and the display;
+        # older and newer pages are read from the history store as the user scrolls
+        self.chat_window_size = 150
+        self.chat_page_size = 50
+        self._mark_base = 0  # Mark name number of chat_history[0], so trimming never renames marks
+        self._has_older = False
+        self._detached = False  # The newest stored messages have been paged out
+        self._paging = False
+        self._page_read = None  # Token of the history page being read in the background
+        self.max_concurrent_requests = 3
+        self.scheduler = RequestScheduler(self.max_concurrent_requests)
+        self.request_ids = itertools.count(1)
+        self.pending_requests = set()
+        self.multi_turn = True  # Send recent turns (and a summary of older ones) with each query
+        self.context_token_budget = 6000
+        self.summary_model = "gemini-2.5-flash"
+        self.metrics = MetricsRegistry()
+        self.warm_up_models = True  # Open the API connection in the background after configuring
+        
+        # Client-side quotas, retries and the Pro -> Flash fallback
+        self.rate_limiter = RateLimiter(rate_limits)
+        self.max_retries = 3
+        self.retry_base_delay = 1.0
+        self.retry_max_delay = 30.0
+        self.model_fallback = model_fallback
+        self.fallback_models = {"gemini-2.5-pro": "gemini-2.5-flash"}
+        self.fallback_latency_budget = 10.0  # Seconds Pro may take (queueing or first token) before falling back
+        self.latency_window = 300.0  # Only first-chunk samples this recent (seconds) count against a model
+        self.probe_interval = 30.0  # While a model is judged too slow, still send it one request this often
+        self._last_probe = {}
+        self._probe_lock = threading.Lock()
+        
+        # "Auto" model routing and hedged requests
+        self.fast_model = "gemini-2.5-flash"
+        self.strong_model = "gemini-2.5-pro"
+        self.light_commands = {'/summarize', '/translate', '/improve', '/explain', '/pros', '/ideas'}
+        self.strong_commands = {'/code', '/fix'}
+        self.strong_modes = {"Coder", "Analyzer"}
+        self.strong_prompt_tokens = 2000  # Longer prompts go to the strong model
+        self.auto_latency_budget = 20.0  # Strong model's recent median reply time above this routes to the fast one
+        self.hedge_requests = hedge  # Hedge every streamed request, not just those routed by "Auto"
+        self.hedge_min_samples = 20  # First-chunk samples needed before a model's p95 is trusted as the deadline
+        self.hedge_min_deadline = 1.0
+        
+        # Large /summarize, /translate and /improve inputs are split and processed in parallel
+        self.map_reduce_commands = {'/summarize', '/translate', '/improve'}
+        self.map_reduce_threshold = 6000  # Estimated tokens of content before splitting
+        self.map_reduce_chunk_tokens = 4000
+        self.map_reduce_parallel = 4
+        
+        # Speculative prefetch: start a complete-looking quick command before Enter is pressed
+        self.speculative_prefetch = speculate
+        self.speculation_delay_ms = 600  # Input must be unchanged this long
+        self.speculation_min_chars = 20  # Content needed after the command
+        self.speculative_commands = {'/summarize', '/translate', '/explain', '/improve', '/code', '/fix', '/ideas', '/pros'}
+        self.speculation = None
+        self._speculation_after = None
+        self.speculation_stats = {"adopted": 0, "discarded": 0, "saved": 0.0, "wasted": 0.0}
+        
+        # Retrieval: relevant earlier exchanges from a local vector index go in a context turn before the prompt
+        self.retrieval = retrieval
+        self.embedding_function = hashing_embedding  # texts -> float32 array of rows
+        self.retrieval_top_k = 4
+        self.retrieval_min_score = 0.25
+        self.retrieval_token_budget = 1500
+        self.retrieval_skip_recent = 40  # Messages this close to the end are already in the prompt
         
         # Available models
         self.available_models = {
+            "Auto": AUTO_MODEL,
             "Gemini 2.5 Flash": "gemini-2.5-flash",
             "Gemini 2.5 Pro": "gemini-2.5-pro"
         }
         
-        # Initialize Gemini API
+        # The SDK and the history stores are set up in the background
         self.api_key = self.load_api_key()
-        if self.api_key:
+        self.sessions = None
+        self.session = None
+        self.history_store = None
+        self.search_index = None
+        self.response_cache = None
+        self.conversation = None
+        self.vector_index = None
+        self.backend_ready = threading.Event()
+        self.history_ready = threading.Event()
+        self.show_when_ready = False
+        
+        if not headless:
+            # Configure CustomTkinter
+            ctk.set_appearance_mode("dark")
+            ctk.set_default_color_theme("blue")
+            
+            # Setup global hotkey first so Ctrl+Space works as early as possible
+            self.setup_hotkey()
+            
+            # Create the main window immediately
+            with self.profiler.phase("create window"):
+                self.create_window()
+            self.profiler.milestone("window ready")
+            if self.show_when_ready:
+                self.window.after(0, self.show_window)
+            threading.Thread(target=self.start_history, name="startup-history", daemon=True).start()
+        
+        # Let other tools reuse this warm process instead of starting their own
+        self.ipc = None
+        if ipc and not headless:
             try:
-                genai.configure(api_key=self.api_key)
-                self.model = genai.GenerativeModel('gemini-1.5-pro')
-            except Exception as e:
-                print(f"Error configuring Gemini: {e}")
-                self.model = None
-        else:
-            self.model = None
+                self.ipc = IPCServer(self)
+                self.ipc.start()
+            except OSError as e:
+                logger.warning("IPC API unavailable: %s", e)
+                self.ipc = None
+        
+        threading.Thread(target=self.start_backend, name="startup-backend", daemon=True).start()
+    
+    def start_backend(self):
+        """Background startup: import and configure the model backend"""
+        try:
+            if isinstance(self.backend, GeminiBackend):
+                with self.profiler.phase("import gemini sdk"):
+                    load_genai()
+            if self.api_key or not self.backend.requires_api_key:
+                with self.profiler.phase(f"configure {self.backend.name}"):
+                    self.configure_backend(self.api_key)
+        except Exception as e:
+            logger.error("Error configuring %s: %s", self.backend.name, e)
+        finally:
+            self.backend_ready.set()
+            if self.window:
+                self.window.after(0, self.update_status)
+    
+    def start_history(self):
+        """Background startup: open the history stores and load the display tail"""
+        entries = []
+        error = None
+        try:
+            with self.profiler.phase("open history stores"):
+                self.response_cache = ResponseCache()
+                self.sessions = SessionManager()
+                self.use_session(self.sessions.open(self.sessions.active, self.context_token_budget,
+                                                    self.retrieval_embedding()))
+            with self.profiler.phase("load history tail"):
+                entries = self.load_history()
+        except Exception as e:
+            logger.error("Error opening history: %s", e)
+            error = e
+        finally:
+            self.history_ready.set()
+        if self.session is None:
+            self.window.after(0, lambda: messagebox.showerror("History", f"❌ Could not open the chat history:\n{error}"))
+            return
+        self.window.after(0, lambda: self.on_session_opened(entries))
+        with self.profiler.phase("compact + index history"):
+            self.prepare_history_store()
+    
+    def use_session(self, session):
+        """Point the history stores at a session; done before history_ready is set"""
+        self.session = session
+        self.history_store = session.history_store
+        self.search_index = session.search_index
+        self.conversation = session.conversation
+        self.vector_index = session.vector_index
+    
+    def retrieval_embedding(self):
+        """Embedding function for the sessions' vector indexes, or None when retrieval is off"""
+        return self.embedding_function if self.retrieval else None
+    
+    def on_session_opened(self, entries):
+        """Apply the active session's mode, model and pins, then show its messages"""
+        settings = self.sessions.settings(self.session.name)
+        if settings.get("mode") in self.get_mode_prompts():
+            self.current_mode = settings["mode"]
+        if settings.get("model") in self.available_models.values():
+            self.current_model = settings["model"]
+        self.pinned_context = list(settings.get("pinned_context", []))
         
-        # Load chat history
-        self.load_history()
+        self.mode_selector.set(self.get_mode_prompts()[self.current_mode]["name"])
+        self.model_selector.set(self.get_model_name(self.current_model))
+        self.session_selector.configure(values=self.sessions.names() + [self.new_session_label], state="normal")
+        self.session_selector.set(self.session.name)
+        self.on_history_loaded(entries)
+    
+    def save_session_settings(self):
+        """Remember the current mode, model and pinned context with the active session"""
+        if self.session is not None:
+            self.sessions.update(self.session.name, mode=self.current_mode, model=self.current_model,
+                                 pinned_context=list(self.pinned_context))
+    
+    def on_session_selected(self, choice):
+        """Handle the title bar session switcher"""
+        if choice != self.new_session_label:
+            self.switch_session(choice)
+            return
+        self.session_selector.set(self.session.name if self.session else SessionManager.DEFAULT)
+        name = ctk.CTkInputDialog(text="Name for the new session:", title="New Session").get_input()
+        name = (name or "").strip()
+        if not name or self.session is None:
+            return
+        if name not in self.sessions.names():
+            self.sessions.create(name, mode=self.current_mode, model=self.current_model)
+        self.switch_session(name)
+    
+    def switch_session(self, name):
+        """Show another named conversation, opening its stores in the background on first use"""
+        if self.session is None or name == self.session.name:
+            return
+        if self.pending_requests:
+            self.session_selector.set(self.session.name)
+            messagebox.showinfo("Sessions", "⏳ Wait for the current replies to finish before switching sessions")
+            return
         
-        # Create the main window immediately
-        self.create_window()
+        self.save_session_settings()
+        # Keep what's on screen for a quick switch back, unless it's a page far from the latest messages
+        self.session.messages = None if self._detached else self.chat_history
+        for entry in self.chat_history:
+            entry.layout = None  # Parsed again on the way back, not held for a session off screen
+        self.history_ready.clear()
+        self.session_selector.configure(state="disabled")
+        self.chat_history = []
+        self._detached = False
+        self._page_read = None
+        self._paging = False
+        self.refresh_chat_display(full=True)
         
-        # Setup global hotkey in a separate thread
-        self.setup_hotkey()
+        previous = self.session.name
+        def open_session():
+            try:
+                session = self.sessions.open(name, self.context_token_budget, self.retrieval_embedding())
+            except Exception as e:
+                logger.error("Error opening session %s: %s", name, e)
+                session = self.sessions.open(previous, self.context_token_budget, self.retrieval_embedding())
+            entries = session.messages if session.messages is not None else self.load_history(store=session.history_store)
+            session.messages = None
+            self.use_session(session)
+            self.history_ready.set()
+            self.window.after(0, lambda: self.on_session_opened(entries))
+            logger.info("Switched to session %s", session.name)
+            if session.vector_index is not None:
+                with self.sessions.in_use(session):
+                    session.vector_index.catch_up(session.history_store)
+        threading.Thread(target=open_session, name="open-session", daemon=True).start()
+    
+    def on_history_loaded(self, entries):
+        """Show loaded history above anything sent while it was loading"""
+        self.chat_history = entries + self.chat_history
+        self._has_older = bool(entries) and entries[0].seq not in (None, 0)
+        self.refresh_chat_display(full=True)
+    
+    def start_benchmark(self):
+        """Start the --bench run once the backend and history are ready"""
+        if self.backend_ready.is_set() and self.history_ready.is_set():
+            self.benchmark.start()
+        else:
+            self.window.after(100, self.start_benchmark)
+    
+    def report_startup_profile(self):
+        """Print the startup profile once the background phases have finished"""
+        if self.backend_ready.is_set() and self.history_ready.is_set():
+            self.profiler.report()
+        else:
+            self.window.after(100, self.report_startup_profile)
     
     def get_mode_prompts(self):
         """Define different conversation modes with system prompts"""
@@ -103,25 +2712,30 @@ class GeminiEverywhere:
             '/code': "Review a piece of code and suggest improvements or best practices.",
             '/fix': "Identify and fix any errors or bugs in the provided code.",
             '/ideas': "Brainstorm creative ideas related to a given topic.",
-            '/pros': "List the pros and cons for a given subject."
+            '/pros': "List the pros and cons for a given subject.",
+            '/search': "Search your whole conversation history and jump to a match.",
+            '/cache': "Show response cache statistics ('/cache clear' empties it)."
         }
         
     def apply_mode_to_query(self, query):
-        """Apply the current mode's system prompt to the user's query"""
+        """Turn the user's input into the prompt text (the mode travels as the system instruction)"""
         # Handle quick commands
         if query.startswith('/'):
             return self.handle_quick_command(query)
-        
-        # Apply pinned context
-        context_text = ""
-        if self.pinned_context:
-            context_text = "\n\nPinned Context:\n" + "\n".join([f"- {item}" for item in self.pinned_context]) + "\n"
+        return query
+    
+    def get_system_instruction(self, query, mode=None, pinned_context=None):
+        """Mode prompt plus pinned context, sent once per model as the system instruction"""
+        if query.startswith('/'):
+            return None  # Quick commands carry their own instructions
+        mode = mode or self.current_mode
+        pinned_context = self.pinned_context if pinned_context is None else pinned_context
         
         modes = self.get_mode_prompts()
-        if self.current_mode in modes:
-            mode_prompt = modes[self.current_mode]["prompt"]
-            return f"System: {mode_prompt}{context_text}\n\nUser: {query}"
-        return query
+        system = modes[mode]["prompt"] if mode in modes else ""
+        if pinned_context:
+            system += "\n\nPinned Context:\n" + "\n".join([f"- {item}" for item in pinned_context])
+        return system or None
     
     def handle_quick_command(self, query):
         """Handle quick commands like /summarize, /translate, etc."""
@@ -158,7 +2772,7 @@ class GeminiEverywhere:
                     if key:
                         return key
         except Exception as e:
-            print(f"Error loading API key from file: {e}")
+            logger.error("Error loading API key from file: %s", e)
         
         # Try environment variable
         env_key = os.getenv('GEMINI_API_KEY')
@@ -167,6 +2781,13 @@ class GeminiEverywhere:
             
         return None
     
+    def configure_backend(self, api_key):
+        """Configure the backend for a key and warm it up in the background"""
+        self.backend.configure(api_key)
+        if self.warm_up_models:
+            model_ids = [model_id for model_id in self.available_models.values() if model_id != AUTO_MODEL]
+            threading.Thread(target=self.backend.warm_up, args=(model_ids,), daemon=True).start()
+    
     def save_api_key(self, api_key):
         """Save API key to file"""
         try:
@@ -174,48 +2795,65 @@ class GeminiEverywhere:
                 f.write(api_key)
             return True
         except Exception as e:
-            print(f"Error saving API key: {e}")
+            logger.error("Error saving API key: %s", e)
             return False
     
-    def load_history(self):
-        """Load chat history from file"""
+    def load_history(self, limit=50, store=None):
+        """Load the most recent chat history from the journal"""
         try:
-            if os.path.exists('gemini_history.json'):
-                with open('gemini_history.json', 'r', encoding='utf-8') as f:
-                    self.chat_history = json.load(f)
+            store = store or self.history_store
+            return [Message.from_dict(record) for record in store.tail(limit)]
         except Exception as e:
-            print(f"Error loading history: {e}")
-            self.chat_history = []
+            logger.error("Error loading history: %s", e)
+            return []
     
-    def save_history(self):
-        """Save chat history to file"""
+    def save_history(self, *messages):
+        """Append messages to the history journal and the search index"""
+        self.history_ready.wait()
         try:
-            # Keep only last 50 messages to prevent file from getting too large
-            if len(self.chat_history) > 50:
-                self.chat_history = self.chat_history[-50:]
-            
-            with open('gemini_history.json', 'w', encoding='utf-8') as f:
-                json.dump(self.chat_history, f, ensure_ascii=False, indent=2)
+            records = [message.to_dict(self.format_timestamp(message)) for message in messages]
+            self.history_store.append(*records)
+            for message, record in zip(messages, records):
+                message.seq = record["seq"]
+            self.search_index.add(*records)
+            if self.vector_index is not None:
+                self.vector_index.add(*records)
+        except Exception as e:
+            logger.error("Error saving history: %s", e)
+    
+    def prepare_history_store(self):
+        """Background upkeep: compact the journal and index anything not yet indexed"""
+        try:
+            with self.sessions.in_use(self.session) as session:
+                session.history_store.compact()
+                session.search_index.catch_up(session.history_store)
+                if session.vector_index is not None:
+                    session.vector_index.catch_up(session.history_store)
         except Exception as e:
-            print(f"Error saving history: {e}")
+            logger.error("Error preparing history: %s", e)
     
     def setup_hotkey(self):
         """Setup global hotkey listener in a separate thread"""
         def hotkey_listener():
             try:
                 keyboard.add_hotkey('ctrl+space', self.toggle_window_safe)
-                print("✅ Hotkey Ctrl+Space registered successfully!")
+                self.profiler.milestone("hotkey ready")
+                logger.info("✅ Hotkey Ctrl+Space registered successfully!")
             except Exception as e:
-                print(f"❌ Error setting up hotkey: {e}")
-                print("You can still use the window manually.")
+                logger.error("❌ Error setting up hotkey: %s", e)
+                logger.warning("You can still use the window manually.")
         
-        self.hotkey_thread = threading.Thread(target=hotkey_listener, daemon=True)
+        self.hotkey_thread = threading.Thread(target=hotkey_listener, name="hotkey", daemon=True)
         self.hotkey_thread.start()
     
     def toggle_window_safe(self):
         """Thread-safe window toggle"""
+        self.hotkey_pressed_at = time.perf_counter()
         if self.window:
             self.window.after(0, self.toggle_window)
+        else:
+            # Pressed before the window exists: show it as soon as it does
+            self.show_when_ready = True
     
     def create_window(self):
         """Create the main overlay window"""
@@ -242,6 +2880,18 @@ class GeminiEverywhere:
         title_label = ctk.CTkLabel(title_frame, text="🤖 Gemini Everywhere", font=("Arial", 16, "bold"))
         title_label.grid(row=0, column=0, sticky="w", padx=10, pady=8)
         
+        # Session switcher; filled in once the session index has loaded
+        self.new_session_label = "➕ New session..."
+        self.session_selector = ctk.CTkOptionMenu(
+            title_frame,
+            values=[SessionManager.DEFAULT],
+            command=self.on_session_selected,
+            width=100,
+            font=("Arial", 11),
+            state="disabled"
+        )
+        self.session_selector.grid(row=0, column=1, padx=3, pady=8)
+        
         # Mode selector dropdown
         modes = self.get_mode_prompts()
         mode_names = [modes[key]["name"] for key in modes.keys()]
@@ -253,7 +2903,7 @@ class GeminiEverywhere:
             width=100,
             font=("Arial", 11)
         )
-        self.mode_selector.grid(row=0, column=1, padx=3, pady=8)
+        self.mode_selector.grid(row=0, column=2, padx=3, pady=8)
         self.mode_selector.set(modes[self.current_mode]["name"])
         
         # Model selector dropdown
@@ -265,7 +2915,7 @@ class GeminiEverywhere:
             width=100,
             font=("Arial", 11)
         )
-        self.model_selector.grid(row=0, column=2, padx=3, pady=8)
+        self.model_selector.grid(row=0, column=3, padx=3, pady=8)
         # Set current model display name
         for name, model_id in self.available_models.items():
             if model_id == self.current_model:
@@ -274,15 +2924,23 @@ class GeminiEverywhere:
         
         # Status indicator
         self.status_label = ctk.CTkLabel(title_frame, text="")
-        self.status_label.grid(row=0, column=3, padx=3, pady=8)
+        self.status_label.grid(row=0, column=4, padx=3, pady=8)
         self.update_status()
         
         close_btn = ctk.CTkButton(title_frame, text="✕", width=30, height=30, command=self.hide_window)
-        close_btn.grid(row=0, column=4, padx=10, pady=8)
+        close_btn.grid(row=0, column=5, padx=10, pady=8)
         
         # Chat display area
         self.chat_display = ctk.CTkTextbox(self.window, wrap="word", font=("Arial", 12))
         self.chat_display.grid(row=1, column=0, sticky="nsew", padx=10, pady=5)
+        self.configure_markdown_tags()
+        scrollbar = getattr(self.chat_display, "_y_scrollbar", None)
+        if scrollbar is not None:
+            # Watch the scroll position to page history in and out
+            def on_scroll(first, last):
+                scrollbar.set(first, last)
+                self.on_chat_scrolled(float(first), float(last))
+            self.chat_display._textbox.configure(yscrollcommand=on_scroll)
         
         # Input frame
         input_frame = ctk.CTkFrame(self.window)
@@ -294,6 +2952,8 @@ class GeminiEverywhere:
         self.query_entry.grid(row=0, column=0, sticky="ew", padx=(5, 5), pady=8)
         self.query_entry.bind("<Return>", self.send_query)
         self.query_entry.bind("<Control-Return>", lambda e: self.query_entry.insert("end", "\n"))
+        self.query_entry.bind("<KeyRelease>", self.on_query_edited)
+        self.query_entry.bind("<FocusIn>", self.on_input_focused)
         
         # Send button
         self.send_btn = ctk.CTkButton(input_frame, text="Send", width=80, command=self.send_query)
@@ -323,13 +2983,23 @@ class GeminiEverywhere:
         commands_btn = ctk.CTkButton(control_frame, text="Commands", command=self.show_commands_dialog, height=32, width=80)
         commands_btn.pack(side="right", padx=3, pady=8)
         
+        search_btn = ctk.CTkButton(control_frame, text="Search", command=self.show_search_dialog, height=32, width=60)
+        search_btn.pack(side="right", padx=3, pady=8)
+        
+        stats_btn = ctk.CTkButton(control_frame, text="Stats", command=self.show_stats_dialog, height=32, width=50)
+        stats_btn.pack(side="right", padx=3, pady=8)
+        
         # Load and display chat history
         self.refresh_chat_display()
         
         # Handle window close
         self.window.protocol("WM_DELETE_WINDOW", self.on_closing)
         
-        print("✅ Window created successfully!")
+        if self.display_mode == "standby":
+            # Lay everything out now so the first show only has to map the window
+            self.window.update_idletasks()
+        
+        logger.debug("✅ Window created successfully!")
     
     def show_commands_dialog(self):
         """Show a dialog with a list of available quick commands."""
@@ -388,30 +3058,26 @@ class GeminiEverywhere:
         """Handle model change from dropdown"""
         if selected_model_name in self.available_models:
             self.current_model = self.available_models[selected_model_name]
-            if self.api_key:
-                try:
-                    self.model = genai.GenerativeModel(self.current_model)
-                    print(f"Model changed to: {selected_model_name}")
-                except Exception as e:
-                    print(f"Error switching model: {e}")
+            self.save_session_settings()
+            logger.info("Model changed to: %s", selected_model_name)
     
     def copy_last_response(self):
         """Copy the last AI response to clipboard"""
         for entry in reversed(self.chat_history):
-            if entry["type"] == "assistant" and "Error:" not in entry["content"]:
+            if entry.role is Role.ASSISTANT and "Error:" not in entry.content:
                 try:
                     import pyperclip
-                    pyperclip.copy(entry["content"])
-                    print("Last response copied to clipboard!")
+                    pyperclip.copy(entry.content)
+                    logger.info("Last response copied to clipboard!")
                     return
                 except ImportError:
                     # Fallback to tkinter clipboard
                     self.window.clipboard_clear()
-                    self.window.clipboard_append(entry["content"])
+                    self.window.clipboard_append(entry.content)
                     self.window.update()
-                    print("Last response copied to clipboard!")
+                    logger.info("Last response copied to clipboard!")
                     return
-        print("No response to copy")
+        logger.info("No response to copy")
     
     def show_pin_dialog(self):
         """Show dialog to manage pinned context"""
@@ -461,8 +3127,9 @@ class GeminiEverywhere:
             text = new_context_entry.get("1.0", "end").strip()
             if text:
                 self.pinned_context.append(text)
+                self.save_session_settings()
                 dialog.destroy()
-                print(f"Added pinned context: {text[:50]}...")
+                logger.info("Added pinned context: %s...", text[:50])
         
         button_frame = ctk.CTkFrame(dialog)
         button_frame.pack(pady=20)
@@ -480,14 +3147,16 @@ class GeminiEverywhere:
         """Remove a pinned context item"""
         if 0 <= index < len(self.pinned_context):
             removed = self.pinned_context.pop(index)
-            print(f"Removed pinned context: {removed[:50]}...")
+            self.save_session_settings()
+            logger.info("Removed pinned context: %s...", removed[:50])
             dialog.destroy()
             self.show_pin_dialog()  # Refresh the dialog
     
     def clear_all_pinned(self, dialog):
         """Clear all pinned context"""
         self.pinned_context = []
-        print("Cleared all pinned context")
+        self.save_session_settings()
+        logger.info("Cleared all pinned context")
         dialog.destroy()
     
     def on_mode_change(self, selected_mode_name):
@@ -497,13 +3166,18 @@ class GeminiEverywhere:
         for key, value in modes.items():
             if value["name"] == selected_mode_name:
                 self.current_mode = key
-                print(f"Mode changed to: {selected_mode_name}")
+                self.save_session_settings()
+                logger.info("Mode changed to: %s", selected_mode_name)
+                self.refresh_chat_display(full=True)
                 break
     
     def update_status(self):
         """Update the status indicator"""
-        if self.model:
-            self.status_label.configure(text="🟢 Connected", text_color="green")
+        if self.backend.is_configured():
+            text = "🟢 Connected" if self.backend.requires_api_key else f"🟢 {self.backend.name.title()}"
+            self.status_label.configure(text=text, text_color="green")
+        elif self.api_key and not self.backend_ready.is_set():
+            self.status_label.configure(text="🟡 Starting...", text_color="orange")
         else:
             self.status_label.configure(text="🔴 No API Key", text_color="red")
     
@@ -526,24 +3200,43 @@ class GeminiEverywhere:
     def show_window(self):
         """Show the overlay window"""
         try:
-            self.window.deiconify()
-            self.window.lift()
-            self.window.focus_force()
-            self.window.attributes('-topmost', True)
-            self.query_entry.focus()
+            if self.display_mode == "standby":
+                # Geometry, stacking and -topmost are already in place; map and take focus
+                self.window.deiconify()
+                self.window.focus_force()
+                self.query_entry.focus_set()
+            else:
+                self.window.deiconify()
+                self.window.lift()
+                self.window.focus_force()
+                self.window.attributes('-topmost', True)
+                self.query_entry.focus()
             self.is_visible = True
-            print("Window shown")
+            logger.debug("Window shown")
         except Exception as e:
-            print(f"Error showing window: {e}")
+            logger.error("Error showing window: %s", e)
     
     def hide_window(self):
         """Hide the overlay window"""
         try:
             self.window.withdraw()
             self.is_visible = False
-            print("Window hidden")
+            self.hotkey_pressed_at = None
+            if self.display_mode == "standby":
+                # Settle any layout still pending so the next show has nothing left to compute
+                self.window.after_idle(self.window.update_idletasks)
+            logger.debug("Window hidden")
         except Exception as e:
-            print(f"Error hiding window: {e}")
+            logger.error("Error hiding window: %s", e)
+    
+    def on_input_focused(self, event=None):
+        """Record how long the hotkey took to put keyboard focus in the input"""
+        pressed, self.hotkey_pressed_at = self.hotkey_pressed_at, None
+        if pressed is None or not self.is_visible:
+            return
+        latency = time.perf_counter() - pressed
+        self.metrics.observe("gemini_hotkey_to_focus_seconds", latency, display=self.display_mode)
+        logger.debug("Hotkey to focus: %.1f ms", latency * 1000)
     
     def send_query(self, event=None):
         """Send query to Gemini"""
@@ -551,87 +3244,717 @@ class GeminiEverywhere:
         if not query:
             return
         
-        if not self.model:
+        # History search is answered locally
+        if query.split()[0].lower() == '/search':
+            self.query_entry.delete(0, 'end')
+            self.show_search_dialog(query[len('/search'):].strip())
+            return
+        if query.split()[0].lower() == '/cache':
+            self.query_entry.delete(0, 'end')
+            self.show_cache_stats(clear=query.lower().endswith('clear'))
+            return
+        
+        # A leading "!" skips the response cache and refreshes the stored answer
+        refresh_cache = query.startswith('!')
+        if refresh_cache:
+            query = query[1:].strip()
+            if not query:
+                return
+        
+        if not self.api_key and self.backend.requires_api_key:
             self.show_api_key_dialog()
             return
         
-        # Disable send button and clear input
-        self.send_btn.configure(state="disabled", text="Sending...")
         self.query_entry.delete(0, 'end')
+        speculation = self.take_speculation(query, refresh_cache)
+        if self._detached:
+            self.return_to_latest()
         
         # Add user message to history
-        timestamp = datetime.now().strftime("%H:%M")
-        user_entry = {
-            "type": "user",
-            "content": query,
-            "timestamp": timestamp
-        }
+        user_entry = Message(Role.USER, query)
         self.chat_history.append(user_entry)
         
-        # Show "thinking" message
-        thinking_entry = {
-            "type": "assistant",
-            "content": "🤔 Thinking...",
-            "timestamp": timestamp
-        }
+        # Show "thinking" message; the request id ties the reply back to this slot
+        request_id = next(self.request_ids)
+        thinking_entry = Message(Role.ASSISTANT, "🤔 Thinking...", created=user_entry.created, request_id=request_id)
         self.chat_history.append(thinking_entry)
         self.refresh_chat_display()
         
-        # Send query in thread to avoid blocking UI
-        modified_query = self.apply_mode_to_query(query)
-        thread = threading.Thread(target=self.get_gemini_response, args=(modified_query, query))
-        thread.daemon = True
-        thread.start()
+        # Queue the request so several can be in flight without blocking the UI
+        if speculation:
+            prompt = speculation["request"]["prompt"]
+            system = speculation["request"]["system"]
+            model_id = speculation["request"]["model_id"]
+        else:
+            prompt = self.build_prompt(query, self.chat_history[:-2])
+            system = self.get_system_instruction(query)
+            model_id = self.current_model
+            if model_id == AUTO_MODEL:
+                model_id = self.route_model(query, prompt, system)
+        request = {
+            "id": request_id,
+            "query": query,
+            "prompt": prompt,
+            "mode": self.current_mode,
+            "model_id": model_id,
+            "auto": self.current_model == AUTO_MODEL,
+            "pinned_context": list(self.pinned_context),
+            "system": system,
+            "chunks": self.plan_map_reduce(query),
+            "placeholder": thinking_entry,
+            "user_entry": user_entry,
+            "refresh_cache": refresh_cache,
+            "speculation": speculation,
+            "retrieve": self.retrieval and system is not None,
+            "enqueued": time.perf_counter()
+        }
+        priority = self.get_request_priority(query, model_id)
+        self.pending_requests.add(request_id)
+        self.scheduler.submit(self.get_gemini_response, request, priority=priority)
+        self.update_send_button()
     
-    def get_gemini_response(self, modified_query, original_query):
-        """Get response from Gemini API"""
+    def route_model(self, query, prompt, system, mode=None):
+        """Pick the model for "Auto" from the command, mode, prompt size and recent latency"""
+        mode = mode or self.current_mode
+        command = query.split()[0].lower() if query.startswith('/') else None
+        if command in self.light_commands:
+            return self.fast_model
+        tokens = estimate_tokens(str(prompt)) + estimate_tokens(system or "")
+        if (command not in self.strong_commands and mode not in self.strong_modes
+                and tokens < self.strong_prompt_tokens):
+            return self.fast_model
+        # Worth the strong model, unless it has been too slow lately
+        recent = self.metrics.percentile("gemini_request_total_seconds", 0.5, min_samples=5,
+                                         max_age=self.latency_window, model=self.strong_model)
+        if recent is not None and recent > self.auto_latency_budget and not self.probe_due(self.strong_model):
+            return self.fast_model
+        return self.strong_model
+    
+    def speculation_key(self, query):
+        """What a sent query must match to adopt a speculative request"""
+        return query, self.current_mode, self.current_model, tuple(self.pinned_context)
+    
+    def on_query_edited(self, event=None):
+        """Debounce typing in the input before considering a speculative request"""
+        if not self.speculative_prefetch:
+            return
+        if self._speculation_after is not None:
+            self.window.after_cancel(self._speculation_after)
+        self._speculation_after = self.window.after(self.speculation_delay_ms, self.maybe_speculate)
+    
+    def maybe_speculate(self):
+        """Start answering the input if it has settled into a complete quick command"""
+        self._speculation_after = None
+        query = self.query_entry.get().strip()
+        if self.speculation and self.speculation["key"] == self.speculation_key(query):
+            return
+        if self.speculation:
+            self.discard_speculation(self.speculation)
+            self.speculation = None
+        
+        command = query.split()[0].lower() if query.startswith('/') else None
+        if command not in self.speculative_commands or len(query[len(command):].strip()) < self.speculation_min_chars:
+            return
+        if self.plan_map_reduce(query) or (not self.api_key and self.backend.requires_api_key):
+            return  # Too expensive to throw away, or nothing to send it with
+        
+        prompt = self.apply_mode_to_query(query)
+        system = self.get_system_instruction(query)
+        model_id = self.current_model
+        auto = model_id == AUTO_MODEL
+        if auto:
+            model_id = self.route_model(query, prompt, system)
+        cache_key = ResponseCache.make_key(model_id, self.current_mode, self.pinned_context, prompt)
+        if self.history_ready.is_set() and self.response_cache.contains(cache_key):
+            return  # Sending it will be answered from the cache anyway
+        self.speculation = {
+            "key": self.speculation_key(query),
+            "request": {"id": f"speculative-{next(self.request_ids)}", "query": query, "prompt": prompt,
+                        "system": system, "model_id": model_id, "auto": auto, "chunks": None, "placeholder": None},
+            "lock": threading.Lock(),
+            "chunks": [],
+            "listener": None,
+            "usage": {},
+            "result": None,
+            "error": None,
+            "started": None,
+            "finished": None,
+            "claimed": None,
+            "cancelled": False,
+            "done": threading.Event()
+        }
+        # Never let a guess hold up a real request
+        self.scheduler.submit(self.run_speculation, self.speculation, priority=PRIORITY_BACKGROUND)
+    
+    def run_speculation(self, speculation):
+        """Background job: answer a quick command that hasn't been sent yet"""
         try:
-            response = self.model.generate_content(modified_query)
+            self.backend_ready.wait()
+            if speculation["cancelled"] or not self.backend.is_configured():
+                raise RuntimeError("speculative request dropped")
+            speculation["started"] = time.perf_counter()
             
-            # Remove "thinking" message
-            if self.chat_history and self.chat_history[-1]["content"] == "🤔 Thinking...":
-                self.chat_history.pop()
+            def on_chunk(text):
+                if speculation["cancelled"]:
+                    raise RuntimeError("speculative request discarded")
+                with speculation["lock"]:
+                    speculation["chunks"].append(text)
+                    if speculation["listener"]:
+                        speculation["listener"](text)
             
-            # Add AI response (show the mode in the timestamp)
-            timestamp = datetime.now().strftime("%H:%M")
-            modes = self.get_mode_prompts()
-            mode_display = modes[self.current_mode]["name"]
+            speculation["result"] = self.generate_reply(speculation["request"], speculation["usage"], on_chunk)
+        except Exception as e:
+            speculation["error"] = e
+        finally:
+            speculation["finished"] = time.perf_counter()
+            speculation["done"].set()
+    
+    def take_speculation(self, query, refresh_cache):
+        """Claim the speculative request if it matches the query being sent, otherwise discard it"""
+        if self._speculation_after is not None:
+            self.window.after_cancel(self._speculation_after)
+            self._speculation_after = None
+        speculation, self.speculation = self.speculation, None
+        if speculation is None:
+            return None
+        if refresh_cache or speculation["key"] != self.speculation_key(query) or speculation["cancelled"]:
+            self.discard_speculation(speculation)
+            return None
+        # Counted as adopted or discarded once the request knows whether it used it
+        speculation["claimed"] = time.perf_counter()
+        return speculation
+    
+    def discard_speculation(self, speculation):
+        speculation["cancelled"] = True
+        now = time.perf_counter()
+        wasted = ((speculation["finished"] or now) - speculation["started"]) if speculation["started"] else 0.0
+        self.speculation_stats["discarded"] += 1
+        self.speculation_stats["wasted"] += wasted
+        self.metrics.inc("gemini_speculations_total", outcome="discarded")
+        self.metrics.inc("gemini_speculation_seconds_total", wasted, kind="wasted")
+    
+    def adopt_speculation(self, speculation, usage, on_chunk):
+        """Finish a request from its speculative twin, replaying what has streamed so far.
+
+        Returns None, with the speculation counted as discarded, if it
+        failed; the caller then sends the request itself.
+        """
+        with speculation["lock"]:
+            for text in speculation["chunks"]:
+                on_chunk(text)
+            speculation["listener"] = on_chunk
+        speculation["done"].wait()
+        if speculation["error"] is not None:
+            logger.debug("Speculative request failed, sending it again: %s", speculation["error"])
+            self.discard_speculation(speculation)
+            return None
+        # Whatever ran before Enter was pressed is latency the user doesn't wait for
+        claimed = speculation["claimed"]
+        saved = max(min(speculation["finished"], claimed) - speculation["started"], 0.0) if speculation["started"] else 0.0
+        self.speculation_stats["adopted"] += 1
+        self.speculation_stats["saved"] += saved
+        self.metrics.inc("gemini_speculations_total", outcome="adopted")
+        self.metrics.inc("gemini_speculation_seconds_total", saved, kind="saved")
+        usage.update(speculation["usage"])
+        return speculation["result"]
+    
+    def build_prompt(self, query, history):
+        """Build the request prompt, adding conversation context to normal queries"""
+        prompt = self.apply_mode_to_query(query)
+        # Quick commands are self-contained; the conversation isn't ready until history has loaded
+        if not self.multi_turn or query.startswith('/') or not self.history_ready.is_set():
+            return prompt
+        contents, evicted = self.conversation.build(history, prompt)
+        if evicted:
+            self.scheduler.submit(self.update_conversation_summary, self.conversation, evicted,
+                                  priority=PRIORITY_BACKGROUND)
+        return contents
+    
+    def update_conversation_summary(self, conversation, evicted):
+        """Background job: fold exchanges that left the context window into the summary.
+
+        ``conversation`` is the session's context as of the request, so a
+        switch before the job runs can't fold them into another session.
+        """
+        self.backend_ready.wait()
+        if not self.backend.is_configured():
+            return
+        try:
+            conversation.update(evicted, self.backend, self.summary_model)
+        except Exception as e:
+            logger.warning("Error updating conversation summary: %s", e)
+    
+    def add_retrieved_context(self, request):
+        """Add the most relevant earlier exchanges to a request's contents.
+
+        Hits already in the recent conversation are skipped, each hit is
+        widened to its question/answer pair, and pairs are added best first
+        until retrieval_top_k or retrieval_token_budget is reached. They go
+        in a turn just before the new prompt, leaving the system instruction
+        (and the context cache built on it) the same for every request, and
+        the cache key on the prompt covers them.
+        """
+        if self.vector_index is None or not self.vector_index.available:
+            return
+        try:
+            recent = {entry.seq for entry in self.chat_history[-self.retrieval_skip_recent:]}
+            hits = self.vector_index.search(request["query"], self.retrieval_top_k * 2 + len(recent))
+            records = self.vector_index.messages({seq + offset for seq, score in hits for offset in (-1, 0, 1)})
+            passages = []
+            used_seqs = set()
+            budget = self.retrieval_token_budget
+            for seq, score in hits:
+                if len(passages) >= self.retrieval_top_k or score < self.retrieval_min_score:
+                    break
+                if seq in recent or seq in used_seqs:
+                    continue
+                record = records.get(seq)
+                if record is None:
+                    continue
+                if record["type"] == Role.USER.value:
+                    pair = [record, records.get(seq + 1)]
+                else:
+                    pair = [records.get(seq - 1), record]
+                pair = [item for item in pair if item is not None and item["seq"] not in recent]
+                text = "\n".join(f"{'User' if item['type'] == Role.USER.value else 'Assistant'}: {item['content']}"
+                                 for item in pair)
+                tokens = estimate_tokens(text)
+                if tokens > budget or text in passages:
+                    continue
+                budget -= tokens
+                used_seqs.update(item["seq"] for item in pair)
+                passages.append(text)
+        except Exception as e:
+            logger.warning("Error retrieving past exchanges: %s", e)
+            return
+        if passages:
+            contents = request["prompt"]
+            if isinstance(contents, str):
+                contents = [{"role": "user", "parts": [contents]}]
+            request["prompt"] = contents[:-1] + [
+                {"role": "user", "parts": ["Relevant earlier conversation (may be out of date):\n\n"
+                                           + "\n\n".join(passages)]},
+                {"role": "model", "parts": ["Got it, I'll keep that in mind."]},
+            ] + contents[-1:]
+            self.metrics.inc("gemini_retrieved_exchanges_total", len(passages))
+            logger.debug("Request %s: retrieved %d earlier exchanges", request["id"], len(passages))
+    
+    def get_request_priority(self, query, model_id):
+        """Quick commands jump ahead of normal queries, which go ahead of long Pro jobs"""
+        if query.startswith('/'):
+            return PRIORITY_QUICK
+        if "pro" in model_id:
+            return PRIORITY_LONG
+        return PRIORITY_NORMAL
+    
+    def get_gemini_response(self, request):
+        """Get response from Gemini API"""
+        # The placeholder becomes the live assistant entry while streaming
+        live_entry = request["placeholder"]
+        self.backend_ready.wait()
+        self.history_ready.wait()
+        if request.get("retrieve"):
+            self.add_retrieved_context(request)
+        started = time.perf_counter()
+        first_token = None
+        chunks = []
+        usage = {}
+        cached = None
+        status = "ok"
+        model_id = request["model_id"]
+        cache_key = ResponseCache.make_key(request["model_id"], request["mode"], request["pinned_context"], request["prompt"])
+        
+        try:
+            cached = None if request["refresh_cache"] else self.response_cache.get(cache_key)
+            if cached is not None:
+                content = cached
+                if request["speculation"]:
+                    self.discard_speculation(request["speculation"])
+            elif not self.backend.is_configured():
+                raise RuntimeError(f"{self.backend.name} backend is not configured")
+            else:
+                def on_chunk(text):
+                    nonlocal first_token
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                        live_entry.mode = request["mode"]
+                        live_entry.content = ""
+                    chunks.append(text)
+                    live_entry.content += text
+                    self.schedule_stream_refresh()
+                
+                reply = None
+                if request["speculation"]:
+                    reply = self.adopt_speculation(request["speculation"], usage, on_chunk)
+                    if reply is None:
+                        # Start over from a clean slate; anything replayed came from the failed twin
+                        chunks.clear()
+                        live_entry.content = ""
+                if reply is None:
+                    reply = self.generate_reply(request, usage, on_chunk)
+                content, model_id, fallback_reason = reply
+            total = time.perf_counter() - started
+            if first_token is None:
+                first_token = total
+            if cached is not None:
+                latency_note = "💾 cached"
+            else:
+                latency_note = f"⚡ {first_token:.1f}s"
+                if request["auto"]:
+                    latency_note += f" • 🧭 {self.get_model_name(request['model_id'])}"
+                if request["chunks"]:
+                    latency_note += f" • 🧩 {len(request['chunks'])} parts"
+                if request["speculation"]:
+                    latency_note += " • 🔮 prefetched"
+                if fallback_reason:
+                    # Note the substitution and cache under the model that actually answered
+                    latency_note += f" • ↪ {self.get_model_name(model_id)} ({fallback_reason})"
+                    self.metrics.inc("gemini_fallbacks_total", requested=request["model_id"], model=model_id)
+                    cache_key = ResponseCache.make_key(model_id, request["mode"], request["pinned_context"], request["prompt"])
+                self.response_cache.put(cache_key, content)
+                logger.info("⏱️ Request %s: first token in %.2fs, complete in %.2fs", request['id'], first_token, total)
             
-            ai_entry = {
-                "type": "assistant",
-                "content": response.text,
-                "timestamp": f"{timestamp} • {mode_display}",
-                "mode": self.current_mode
-            }
-            self.chat_history.append(ai_entry)
+            # Add AI response (the mode and latency note are shown next to its time)
+            final_entry = Message(Role.ASSISTANT, content, mode=request["mode"], model=model_id, note=latency_note)
             
         except Exception as e:
-            print(f"Error getting Gemini response: {e}")
-            # Remove "thinking" message
-            if self.chat_history and self.chat_history[-1]["content"] == "🤔 Thinking...":
-                self.chat_history.pop()
+            logger.warning("Error getting Gemini response: %s", e)
+            status = "error"
+            content = ""
             
-            # Add error message
-            timestamp = datetime.now().strftime("%H:%M")
-            error_entry = {
-                "type": "assistant",
-                "content": f"❌ Error: {str(e)}\n\nPlease check your API key or try again.",
-                "timestamp": timestamp
-            }
-            self.chat_history.append(error_entry)
+            # Add error message, keeping whatever was streamed before the failure
+            partial = "".join(chunks)
+            final_entry = Message(
+                Role.ASSISTANT,
+                f"{partial}\n\n❌ Error: {str(e)}" if partial else f"❌ Error: {str(e)}\n\nPlease check your API key or try again."
+            )
+        
+        # Update display on the Tk thread and save history
+        self.window.after(0, lambda: self.finish_request(request, final_entry))
+        done = time.perf_counter()
+        self.metrics.record_request({
+            "id": request["id"],
+            "model": model_id,
+            "mode": request["mode"],
+            "enqueued": request["enqueued"],
+            "started": started,
+            "sent": usage.get("sent", started),
+            "first_chunk": started + first_token if first_token is not None else done,
+            "done": done,
+            "cache_hit": cached is not None,
+            "status": status,
+            "prompt_tokens": usage.get("prompt_tokens", 0 if cached is not None else estimate_tokens(str(request["prompt"]))),
+            "response_tokens": usage.get("response_tokens", 0 if cached is not None else estimate_tokens(content))
+        })
+        self.save_history(request["user_entry"], final_entry)
+    
+    def choose_model(self, model_id, tokens):
+        """Apply the fallback policy; returns (model id to use, reason or None)"""
+        fallback = self.fallback_models.get(model_id)
+        if not self.model_fallback or not fallback:
+            return model_id, None
+        if self.rate_limiter.estimate(model_id, tokens) > self.fallback_latency_budget:
+            return fallback, "rate limited"
+        slow = self.metrics.percentile("gemini_request_first_chunk_seconds", 0.95, max_age=self.latency_window,
+                                       model=model_id)
+        if slow is not None and slow > self.fallback_latency_budget and not self.probe_due(model_id):
+            return fallback, f"p95 {slow:.0f}s"
+        return model_id, None
+    
+    def probe_due(self, model_id):
+        """True at most once per probe_interval, so a model judged too slow still gets fresh samples"""
+        now = time.monotonic()
+        with self._probe_lock:
+            if now - self._last_probe.get(model_id, float("-inf")) < self.probe_interval:
+                return False
+            self._last_probe[model_id] = now
+        logger.info("Probing %s despite its recent latency", model_id)
+        return True
+    
+    def generate_with_retries(self, request, usage, on_chunk):
+        """Send a request within the rate limits, retrying transient errors with backoff.
+        
+        Returns (content, model id that answered, fallback reason or None).
+        A stream that fails after text has arrived is not retried, since the
+        partial reply is already on screen.
+        """
+        tokens = estimate_tokens(str(request["prompt"])) + estimate_tokens(request["system"] or "")
+        model_id, fallback_reason = self.choose_model(request["model_id"], tokens)
+        attempt = 0
+        while True:
+            delay = self.rate_limiter.reserve(model_id, tokens)
+            self.metrics.observe("gemini_rate_limit_wait_seconds", delay, model=model_id)
+            if delay > 0:
+                self.show_request_status(request, f"⏳ Waiting {delay:.0f}s for the {self.get_model_name(model_id)} rate limit...")
+                time.sleep(delay)
+            streamed = False
+            usage["sent"] = time.perf_counter()  # Latency metrics start here, after any rate limit or backoff wait
+            try:
+                if self.stream_responses:
+                    chunks = []
+                    stream, hedge_model, hedge_usage = self.open_stream(request, model_id, tokens, usage)
+                    for text in stream:
+                        streamed = True
+                        chunks.append(text)
+                        on_chunk(text)
+                    if getattr(stream, "hedged", False):
+                        won = stream.winner == 1
+                        self.metrics.inc("gemini_hedges_total", model=hedge_model, outcome="won" if won else "lost")
+                        if won:
+                            usage.update(hedge_usage)
+                            return "".join(chunks), hedge_model, "hedged"
+                    return "".join(chunks), model_id, fallback_reason
+                return self.backend.generate(model_id, request["prompt"], request["system"], usage), model_id, fallback_reason
+            except Exception as e:
+                if streamed or attempt >= self.max_retries or not is_transient_error(e):
+                    raise
+                attempt += 1
+                self.metrics.inc("gemini_retries_total", model=model_id)
+                fallback = self.fallback_models.get(model_id)
+                if self.model_fallback and fallback and is_throttle_error(e):
+                    logger.warning("Request %s: %s throttled (%s), falling back to %s", request['id'], model_id, e, fallback)
+                    model_id, fallback_reason = fallback, "throttled"
+                    continue
+                delay = backoff_delay(attempt, self.retry_base_delay, self.retry_max_delay)
+                logger.warning("Request %s: %s; retrying in %.1fs (attempt %d of %d)",
+                               request['id'], e, delay, attempt, self.max_retries)
+                self.show_request_status(request, f"🔄 Retrying in {delay:.0f}s ({e})...")
+                time.sleep(delay)
+    
+    def plan_map_reduce(self, query):
+        """Split the content of a large /summarize, /translate or /improve into parts, or None if it fits"""
+        command = query.split()[0].lower() if query.startswith('/') else None
+        if command not in self.map_reduce_commands:
+            return None
+        content = query[len(command):].strip()
+        if estimate_tokens(content) <= self.map_reduce_threshold:
+            return None
+        return split_text(content, self.map_reduce_chunk_tokens)
+    
+    def answer_query(self, request_id, query, mode, model_id, usage, on_chunk):
+        """Answer a query outside the chat (batch mode, IPC clients); returns (content, model id, note)"""
+        if mode not in self.get_mode_prompts():
+            raise ValueError(f"unknown mode {mode!r}")
+        prompt = self.apply_mode_to_query(query)
+        system = self.get_system_instruction(query, mode=mode, pinned_context=[])
+        auto = model_id == AUTO_MODEL
+        if auto:
+            model_id = self.route_model(query, prompt, system, mode=mode)
+        request = {"id": request_id, "query": query, "prompt": prompt, "system": system, "model_id": model_id,
+                   "auto": auto, "chunks": self.plan_map_reduce(query), "placeholder": None}
+        return self.generate_reply(request, usage, on_chunk)
+    
+    def generate_reply(self, request, usage, on_chunk):
+        """Answer a request in one call, or by map-reduce when plan_map_reduce split it"""
+        if request.get("chunks"):
+            return self.run_map_reduce(request, usage, on_chunk)
+        return self.generate_with_retries(request, usage, on_chunk)
+    
+    def map_prompts(self, request, prompts, usage, label, answered):
+        """Run prompts concurrently and return the replies in order, showing progress in the overlay.
+        
+        The (model id, fallback reason) of each part is appended to ``answered``.
+        """
+        results = [None] * len(prompts)
+        finished = queue.Queue()
+        cancelled = threading.Event()
+        
+        def run_part(index):
+            if cancelled.is_set():
+                return
+            part_usage = {}
+            part = {"id": f"{request['id']}.{index + 1}", "prompt": prompts[index], "system": None,
+                    "model_id": request["model_id"], "placeholder": None}
+            try:
+                reply = self.generate_with_retries(part, part_usage, lambda text: None)
+                finished.put((index, reply, part_usage, None))
+            except Exception as e:
+                finished.put((index, None, part_usage, e))
+        
+        pool = RequestScheduler(min(self.map_reduce_parallel, len(prompts)))
+        for index in range(len(prompts)):
+            pool.submit(run_part, index)
+        try:
+            self.show_request_status(request, f"🧩 {label} 0/{len(prompts)} parts...")
+            for done in range(1, len(prompts) + 1):
+                index, reply, part_usage, error = finished.get()
+                if error is not None:
+                    raise error
+                results[index], model_id, fallback_reason = reply
+                answered.append((model_id, fallback_reason))
+                for key, value in part_usage.items():
+                    if key != "sent":
+                        usage[key] = usage.get(key, 0) + value
+                self.show_request_status(request, f"🧩 {label} {done}/{len(prompts)} parts...")
+        finally:
+            cancelled.set()
+            pool.shutdown()
+        return results
+    
+    def run_map_reduce(self, request, usage, on_chunk):
+        """Process the parts of a large quick command in parallel, then combine them.
+        
+        Translations and rewrites are reassembled in order; summaries of the
+        parts are summarized again, level by level, until they fit in one
+        final request, which is streamed as usual.
+        """
+        command = request["query"].split()[0].lower()
+        parts = request["chunks"]
+        answered = []
+        replies = self.map_prompts(
+            request, [self.handle_quick_command(f"{command} {part}") for _, part in parts], usage,
+            "Summarizing" if command == '/summarize' else "Translating" if command == '/translate' else "Rewriting",
+            answered
+        )
+        if command != '/summarize':
+            content = "".join(separator + reply.strip() for (separator, _), reply in zip(parts, replies))
+            on_chunk(content)
+            return (content, *self.combine_answered(request, answered))
+        
+        # Hierarchical reduce: combine partial summaries until they fit in one request
+        while estimate_tokens("\n\n".join(replies)) > self.map_reduce_chunk_tokens:
+            groups = split_text("\n\n".join(replies), self.map_reduce_chunk_tokens)
+            if len(groups) >= len(replies):
+                break  # The summaries are not getting any shorter
+            replies = self.map_prompts(request, [self.combine_summaries_prompt(group) for _, group in groups],
+                                       usage, "Combining", answered)
+        final = dict(request, prompt=self.combine_summaries_prompt("\n\n".join(replies)), chunks=None)
+        final_usage = {}
+        content, model_id, fallback_reason = self.generate_with_retries(final, final_usage, on_chunk)
+        answered.append((model_id, fallback_reason))
+        for key, value in final_usage.items():
+            usage[key] = value if key == "sent" else usage.get(key, 0) + value
+        return (content, *self.combine_answered(request, answered))
+    
+    def combine_answered(self, request, answered):
+        """(model id, fallback reason) for a reply put together from calls answered as in ``answered``.
+        
+        Any substitution is reported under the substitute model, noting how
+        many of the calls it answered when it wasn't all of them.
+        """
+        substituted = [(model_id, reason) for model_id, reason in answered if reason]
+        if not substituted:
+            return request["model_id"], None
+        model_id, reason = collections.Counter(substituted).most_common(1)[0][0]
+        if len(substituted) < len(answered):
+            reason = f"{reason}, {len(substituted)}/{len(answered)} parts"
+        return model_id, reason
+    
+    def combine_summaries_prompt(self, summaries):
+        return ("Please combine these summaries of consecutive parts of one document "
+                f"into a single concise summary:\n\n{summaries}")
+    
+    def open_stream(self, request, model_id, tokens, usage):
+        """Start streaming a reply, hedged with a backup request once the model has a latency history.
+        
+        Only requests routed by "Auto" are hedged, unless hedge_requests
+        (--hedge) is set; a model the user picked explicitly is otherwise
+        never swapped for the backup. Returns (chunk iterator, backup model
+        id, usage dict the backup fills).
+        """
+        hedge_model = self.fallback_models.get(model_id, model_id) if self.model_fallback else model_id
+        hedge_usage = {}
+        deadline = None
+        if self.hedge_requests or request.get("auto"):
+            deadline = self.metrics.percentile("gemini_request_first_chunk_seconds", 0.95,
+                                               min_samples=self.hedge_min_samples, model=model_id)
+        if deadline is None:
+            return self.backend.stream(model_id, request["prompt"], request["system"], usage), hedge_model, hedge_usage
+        
+        def start_backup():
+            # Don't spend quota on a backup that would have to wait for it anyway
+            if self.rate_limiter.estimate(hedge_model, tokens) > 0:
+                return None
+            self.rate_limiter.reserve(hedge_model, tokens)
+            logger.info("Request %s: no reply from %s after %.1fs, hedging with %s",
+                        request['id'], model_id, deadline, hedge_model)
+            return self.backend.stream(hedge_model, request["prompt"], request["system"], hedge_usage)
         
-        # Update display and save history
-        self.window.after(0, self.refresh_chat_display_and_enable_send)
-        self.save_history()
+        stream = HedgedStream(
+            lambda: self.backend.stream(model_id, request["prompt"], request["system"], usage),
+            start_backup,
+            max(deadline, self.hedge_min_deadline)
+        )
+        return stream, hedge_model, hedge_usage
+    
+    def show_request_status(self, request, text):
+        """Show progress (rate limit waits, retries) in a request's placeholder before any text arrives"""
+        if request["placeholder"] is not None:
+            request["placeholder"].content = text
+            self.schedule_stream_refresh()
+    
+    def get_model_name(self, model_id):
+        """Display name for a model id"""
+        for name, available_id in self.available_models.items():
+            if available_id == model_id:
+                return name
+        return model_id
+    
+    def replace_live_entry(self, request_id, final_entry):
+        """Swap a request's placeholder/streaming entry for the consolidated one"""
+        for i in range(len(self.chat_history) - 1, -1, -1):
+            if self.chat_history[i].request_id == request_id:
+                self.chat_history[i] = final_entry
+                return True
+        return False
+    
+    def schedule_stream_refresh(self):
+        """Coalesce streamed chunks into at most one pending display refresh"""
+        if self._stream_refresh_pending or self.window is None:
+            return
+        self._stream_refresh_pending = True
+        self.window.after(30, self.flush_stream_refresh)
+    
+    def flush_stream_refresh(self):
+        """Push the streamed text received so far to the chat display"""
+        self._stream_refresh_pending = False
+        self.refresh_chat_display()
     
-    def refresh_chat_display_and_enable_send(self):
-        """Refresh display and re-enable send button"""
+    def finish_request(self, request, final_entry):
+        """Land a finished reply in its own slot, whatever order requests complete in"""
+        self.pending_requests.discard(request["id"])
+        self.replace_live_entry(request["id"], final_entry)
         self.refresh_chat_display()
-        self.send_btn.configure(state="normal", text="Send")
+        self.update_send_button()
+        if self.benchmark:
+            self.benchmark.on_request_done(request, final_entry)
     
-    def refresh_chat_display(self):
-        """Refresh the chat display"""
+    def update_send_button(self):
+        """Show how many requests are queued or running on the Send button"""
+        in_flight = len(self.pending_requests)
+        self.send_btn.configure(text=f"Send ({in_flight})" if in_flight else "Send")
+    
+    def refresh_chat_display(self, full=False):
+        """Refresh the chat display, only re-rendering entries that changed"""
+        if full or not self.chat_history or not self._rendered or len(self._rendered) > len(self.chat_history):
+            self.redraw_chat_display()
+            return
+        
+        # Replace entries whose content changed (placeholders, streaming replies)
+        for i, (entry, content, mode, note) in enumerate(self._rendered):
+            current = self.chat_history[i]
+            if current is entry and current.mode is mode and current.note is note:
+                if current.content is content or self.extend_rendered_entry(i, content):
+                    continue
+            self.replace_rendered_entry(i, current)
+        
+        # Append entries that are not on screen yet
+        for i in range(len(self._rendered), len(self.chat_history)):
+            self.append_rendered_entry(self.chat_history[i])
+        self.trim_chat_window(from_top=True)
+        
+        # Scroll to bottom
+        if not self._detached:
+            self.chat_display.see("end")
+    
+    def redraw_chat_display(self):
+        """Clear the chat display and render the whole history from scratch"""
         self.chat_display.delete("1.0", "end")
+        for i in range(len(self._rendered)):
+            self.chat_display.mark_unset(self.mark_name(i))
+        self._rendered = []
+        self._render_jobs.clear()
+        self._mark_base = 0
         
         if not self.chat_history:
             modes = self.get_mode_prompts()
@@ -665,23 +3988,449 @@ Click the "Commands" button below for a list of quick actions like summarizing,
             self.chat_display.insert("end", welcome_text)
         else:
             for entry in self.chat_history:
-                timestamp = entry.get("timestamp", "")
-                content = entry["content"]
-                
-                if entry["type"] == "user":
-                    self.chat_display.insert("end", f"[{timestamp}] You:\n{content}\n\n")
-                else:
-                    self.chat_display.insert("end", f"[{timestamp}] Gemini:\n{content}\n\n")
+                self.append_rendered_entry(entry)
         
         # Scroll to bottom
-        self.chat_display.see("end")
+        if not self._detached:
+            self.chat_display.see("end")
+    
+    def format_timestamp(self, entry):
+        """The "14:02 • 💻 Coder • ⚡ 1.2s" label shown above a message"""
+        if entry.legacy_timestamp is not None:
+            return entry.legacy_timestamp
+        parts = [time.strftime("%H:%M", time.localtime(entry.created))]
+        if entry.mode:
+            modes = self.get_mode_prompts()
+            parts.append(modes[entry.mode]["name"] if entry.mode in modes else entry.mode)
+        if entry.note:
+            parts.append(entry.note)
+        return " • ".join(parts)
+    
+    def format_entry(self, entry):
+        """Format a history entry the way it appears in the chat display, as ``(text, tags)`` segments"""
+        timestamp = self.format_timestamp(entry)
+        speaker = "You" if entry.role is Role.USER else "Gemini"
+        return [(f"[{timestamp}] {speaker}:\n", ()), *self.layout_entry(entry), ("\n\n", ())]
+    
+    def layout_entry(self, entry):
+        """Segments for an entry's content, parsed once per content and
+        dropped again when the entry leaves the display (trim_chat_window,
+        switch_session), so only on-screen messages hold a parsed copy.
+        
+        User messages and replies still streaming are shown as plain text,
+        so a growing reply can be extended in place; the finished reply is
+        formatted once.
+        """
+        layout = entry.layout
+        if layout is None or layout[0] is not entry.content:
+            if entry.role is Role.USER or entry.request_id is not None:
+                layout = (entry.content, [(entry.content, ())])
+            else:
+                layout = (entry.content, parse_markdown(entry.content))
+            entry.layout = layout
+        return layout[1]
+    
+    def configure_markdown_tags(self):
+        """Fonts and colours for rendered markdown"""
+        # CTkTextbox.tag_config refuses font=, so configure the underlying Tk text widget
+        textbox = self.chat_display._textbox
+        textbox.tag_config("md_h1", font=("Arial", 16, "bold"))
+        textbox.tag_config("md_h2", font=("Arial", 14, "bold"))
+        textbox.tag_config("md_h3", font=("Arial", 13, "bold"))
+        textbox.tag_config("md_bold", font=("Arial", 12, "bold"))
+        textbox.tag_config("md_code", font=("Consolas", 11), background="#2b2b2b")
+        textbox.tag_config("md_code_block", font=("Consolas", 11), background="#1e1e1e",
+                           lmargin1=10, lmargin2=10)
+    
+    def mark_name(self, index):
+        """Text mark at the start of chat_history[index] in the display"""
+        return f"msg{self._mark_base + index}"
+    
+    def append_rendered_entry(self, entry):
+        """Append an entry to the end of the chat display"""
+        self._rendered.append((entry, entry.content, entry.mode, entry.note))
+        self.insert_rendered_entry(len(self._rendered) - 1)
+    
+    def replace_rendered_entry(self, index, entry):
+        """Re-render a single entry in place, leaving the rest of the display untouched"""
+        end = self.mark_name(index + 1) if index + 1 < len(self._rendered) else "end-1c"
+        self.chat_display.delete(self.mark_name(index), end)
+        self._rendered[index] = (entry, entry.content, entry.mode, entry.note)
+        self.insert_rendered_entry(index)
+    
+    def extend_rendered_entry(self, index, old_content):
+        """Insert just the newly streamed text of a live reply; False if it needs a full re-render"""
+        entry = self._rendered[index][0]
+        if (entry.request_id is None or self._mark_base + index in self._render_jobs
+                or not entry.content.startswith(old_content)):
+            return False
+        end = self.mark_name(index + 1) if index + 1 < len(self._rendered) else "end-1c"
+        # The text ends with the entry's blank line; the new text goes just before it
+        self.insert_display_text(f"{end} - 2 chars", entry.content[len(old_content):], ())
+        self._rendered[index] = (entry, entry.content, entry.mode, entry.note)
+        return True
+    
+    def insert_rendered_entry(self, index):
+        """Render _rendered[index] just above the next entry (or at the end), a slice at a time"""
+        mark = self.mark_name(index)
+        next_mark = self.mark_name(index + 1) if index + 1 < len(self._rendered) else None
+        self.chat_display.mark_set(mark, self.chat_display.index(next_mark or "end-1c"))
+        self.chat_display.mark_gravity(mark, "left")
+        token = object()
+        self._render_jobs[self._mark_base + index] = token
+        self.render_slice(self._mark_base + index, token, self.format_entry(self._rendered[index][0]))
+    
+    def render_slice(self, number, token, segments, segment=0, offset=0):
+        """Insert up to render_slice_budget worth of an entry's remaining segments, then yield to Tk"""
+        if self._render_jobs.get(number) is not token:
+            return  # The entry was re-rendered since
+        index = number - self._mark_base
+        if not 0 <= index < len(self._rendered):
+            del self._render_jobs[number]  # Paged out
+            return
+        
+        deadline = time.perf_counter() + self.render_slice_budget
+        while segment < len(segments):
+            # Up to render_chunk_size characters per insert, each piece carrying its tags
+            args = []
+            size = 0
+            while segment < len(segments) and size < self.render_chunk_size:
+                text, tags = segments[segment]
+                piece = text[offset:offset + self.render_chunk_size - size]
+                args += (piece, tags)
+                size += len(piece)
+                offset += len(piece)
+                if offset >= len(text):
+                    segment += 1
+                    offset = 0
+            if index + 1 < len(self._rendered):
+                # Let the next entry's mark move along with the inserted text
+                next_mark = self.mark_name(index + 1)
+                self.chat_display.mark_gravity(next_mark, "right")
+                self.insert_display_text(next_mark, *args)
+                self.chat_display.mark_gravity(next_mark, "left")
+            else:
+                self.insert_display_text("end-1c", *args)
+                if not self._detached:
+                    self.chat_display.see("end")
+            if segment < len(segments) and time.perf_counter() >= deadline:
+                self.window.after(1, self.render_slice, number, token, segments, segment, offset)
+                return
+        del self._render_jobs[number]
+    
+    def insert_display_text(self, position, *args):
+        """Insert text/tags pairs, keeping the view still when the text lands above it"""
+        textbox = self.chat_display._textbox
+        above = textbox.compare(position, "<=", "@0,0")
+        if above:
+            textbox.mark_set("view_top", "@0,0")
+            textbox.mark_gravity("view_top", "right")
+        textbox.insert(position, *args)
+        if above:
+            textbox.yview("view_top")
+    
+    def prepend_rendered_entries(self, entries):
+        """Insert older entries above everything on screen, keeping the current view in place"""
+        if not entries:
+            return
+        first_mark = self.mark_name(0) if self._rendered else None
+        self._mark_base -= len(entries)
+        self.chat_history[:0] = entries
+        self._rendered[:0] = [(entry, entry.content, entry.mode, entry.note) for entry in entries]
+        # Newest first, each just above the entry after it, so every mark is placed by Tk's own index
+        for i in range(len(entries) - 1, -1, -1):
+            self.insert_rendered_entry(i)
+        if first_mark:
+            self.chat_display._textbox.yview(first_mark)
+    
+    def trim_chat_window(self, from_top):
+        """Drop messages beyond chat_window_size from the top or the bottom of the display"""
+        excess = len(self.chat_history) - self.chat_window_size
+        if excess <= 0:
+            return
+        if from_top:
+            self.chat_display.delete("1.0", self.mark_name(excess))
+            for i in range(excess):
+                self.chat_display.mark_unset(self.mark_name(i))
+            self._mark_base += excess
+            for entry in self.chat_history[:excess]:
+                entry.layout = None
+            del self.chat_history[:excess]
+            del self._rendered[:excess]
+            self._has_older = True
+        else:
+            keep = len(self.chat_history) - excess
+            if any(entry.seq is None for entry in self.chat_history[keep:]):
+                return  # Never page out replies that are still in flight or unsaved
+            self.chat_display.delete(self.mark_name(keep), "end-1c")
+            for i in range(keep, len(self.chat_history)):
+                self.chat_display.mark_unset(self.mark_name(i))
+                self.chat_history[i].layout = None
+            del self.chat_history[keep:]
+            del self._rendered[keep:]
+            self._detached = True
+    
+    def on_chat_scrolled(self, first, last):
+        """Page older messages in at the top, and newer ones back in at the bottom"""
+        if self._paging or not self.history_ready.is_set() or not self.chat_history:
+            return
+        if first <= 0.0 and self._has_older:
+            self._paging = True
+            self.window.after_idle(self.load_older_messages)
+        elif last >= 1.0 and self._detached:
+            self._paging = True
+            self.window.after_idle(self.load_newer_messages)
+    
+    def read_history_page(self, read, apply):
+        """Run ``read(history_store)`` on a worker thread, then ``apply`` its messages on the Tk thread.
+        
+        read_range and tail decode whole journal segments, far too slow for
+        the Tk thread. A newer read supersedes one still in flight, whose
+        result is dropped; _paging stays set until the last one is applied.
+        """
+        store = self.history_store
+        token = self._page_read = object()
+        self._paging = True
+        
+        def run():
+            try:
+                messages = [Message.from_dict(record) for record in read(store)]
+            except Exception as e:
+                logger.error("Error reading history: %s", e)
+                messages = []
+            self.window.after(0, finish, messages)
+        
+        def finish(messages):
+            if self._page_read is not token or self.history_store is not store:
+                return
+            self._page_read = None
+            try:
+                apply(messages)
+            finally:
+                self._paging = False
+        
+        threading.Thread(target=run, name="history-page", daemon=True).start()
+    
+    def load_older_messages(self):
+        first_seq = self.chat_history[0].seq if self.chat_history else None
+        if first_seq is None or first_seq == 0:
+            self._has_older = False
+            self._paging = False
+            return
+        
+        def apply(older):
+            if not older:
+                self._has_older = False
+                return
+            self.prepend_rendered_entries(older)
+            self.trim_chat_window(from_top=False)
+        self.read_history_page(lambda store: store.read_range(max(first_seq - self.chat_page_size, 0), first_seq), apply)
+    
+    def load_newer_messages(self):
+        last_seq = self.chat_history[-1].seq
+        
+        def apply(newer):
+            if len(newer) < self.chat_page_size:
+                self._detached = False  # Reached the newest stored message
+            for message in newer:
+                self.chat_history.append(message)
+                self.append_rendered_entry(message)
+            self.trim_chat_window(from_top=True)
+        self.read_history_page(lambda store: store.read_range(last_seq + 1, last_seq + 1 + self.chat_page_size), apply)
+    
+    def return_to_latest(self):
+        """Reload the newest messages after the user paged far back"""
+        def apply(page):
+            # Keep what is still unsaved, and anything saved after the page was read
+            newest = page[-1].seq if page else -1
+            recent = [entry for entry in self.chat_history if entry.seq is None or entry.seq > newest]
+            self.chat_history = page + recent
+            self._detached = False
+            self._has_older = True
+            self.refresh_chat_display(full=True)
+        self.read_history_page(lambda store: store.tail(self.chat_page_size), apply)
     
     def clear_history(self):
         """Clear chat history"""
         self.chat_history = []
-        self.refresh_chat_display()
-        self.save_history()
-        print("Chat history cleared")
+        self._has_older = False
+        self._detached = False
+        self._page_read = None
+        self._paging = False
+        self.refresh_chat_display(full=True)
+        threading.Thread(target=self.clear_stored_history, daemon=True).start()
+        logger.info("Chat history cleared")
+    
+    def clear_stored_history(self):
+        """Clear the journal and the search index"""
+        self.history_ready.wait()
+        self.history_store.clear()
+        self.conversation.reset()
+        self.search_index.clear()
+        if self.vector_index is not None:
+            self.vector_index.clear()
+    
+    def show_search_dialog(self, initial_query=""):
+        """Show a dialog to search the whole conversation history"""
+        dialog = ctk.CTkToplevel(self.window)
+        dialog.title("Search History")
+        dialog.geometry("550x450")
+        dialog.attributes('-topmost', True)
+        dialog.transient(self.window)
+        
+        search_frame = ctk.CTkFrame(dialog)
+        search_frame.pack(fill="x", padx=15, pady=(15, 5))
+        search_frame.grid_columnconfigure(0, weight=1)
+        
+        search_entry = ctk.CTkEntry(search_frame, placeholder_text="Search all messages...")
+        search_entry.grid(row=0, column=0, sticky="ew", padx=5, pady=8)
+        
+        status_label = ctk.CTkLabel(dialog, text="", font=("Arial", 11))
+        status_label.pack(anchor="w", padx=20)
+        
+        results_frame = ctk.CTkScrollableFrame(dialog)
+        results_frame.pack(fill="both", expand=True, padx=15, pady=10)
+        
+        def run_search(event=None):
+            for child in results_frame.winfo_children():
+                child.destroy()
+            if not self.history_ready.is_set():
+                status_label.configure(text="⏳ History is still loading, try again in a moment")
+                return
+            started = time.perf_counter()
+            hits = self.search_index.search(search_entry.get())
+            elapsed = (time.perf_counter() - started) * 1000
+            status_label.configure(text=f"{len(hits)} results in {elapsed:.1f} ms")
+            
+            for seq, role, timestamp, snippet in hits:
+                who = "You" if role == "user" else "Gemini"
+                btn = ctk.CTkButton(
+                    results_frame,
+                    text=f"[{timestamp}] {who}: {' '.join(snippet.split())}",
+                    anchor="w",
+                    fg_color="transparent",
+                    border_width=1,
+                    command=lambda hit=seq: self.jump_to_message(hit)
+                )
+                btn.pack(fill="x", pady=3, padx=5)
+        
+        search_btn = ctk.CTkButton(search_frame, text="Search", width=80, command=run_search)
+        search_btn.grid(row=0, column=1, padx=5, pady=8)
+        search_entry.bind("<Return>", run_search)
+        dialog.bind("<Escape>", lambda e: dialog.destroy())
+        
+        search_entry.focus()
+        if initial_query:
+            search_entry.insert(0, initial_query)
+            run_search()
+    
+    def jump_to_message(self, seq):
+        """Scroll the chat display to a stored message, loading older history if needed"""
+        loaded = [entry.seq for entry in self.chat_history if entry.seq is not None]
+        if loaded and loaded[0] <= seq <= loaded[-1]:
+            self.highlight_message(seq)
+            return
+        
+        def apply(page):
+            at_tail = not page or page[-1].seq >= self.history_store.next_seq - 1
+            newest = page[-1].seq if page else -1
+            recent = [entry for entry in self.chat_history if entry.seq is None or entry.seq > newest]
+            self.chat_history = page + (recent if at_tail else [])
+            self._detached = not at_tail
+            self._has_older = True
+            self.refresh_chat_display(full=True)
+            self.highlight_message(seq)
+        # Page in the stored messages around the hit instead of everything up to it
+        half = self.chat_page_size // 2
+        self.read_history_page(lambda store: store.read_range(max(seq - half, 0), seq + half), apply)
+    
+    def highlight_message(self, seq):
+        """Mark a loaded message and bring it into view"""
+        for i, entry in enumerate(self.chat_history):
+            if entry.seq == seq:
+                end = self.mark_name(i + 1) if i + 1 < len(self._rendered) else "end"
+                self.chat_display.tag_remove("search_hit", "1.0", "end")
+                self.chat_display.tag_add("search_hit", self.mark_name(i), end)
+                self.chat_display.tag_config("search_hit", background="#3a3a00")
+                self.chat_display.see(end)
+                self.chat_display.see(self.mark_name(i))
+                self.show_window()
+                return
+        logger.info("Message %s is no longer in history", seq)
+    
+    def show_stats_dialog(self):
+        """Show live per-model/mode latency and token statistics"""
+        dialog = ctk.CTkToplevel(self.window)
+        dialog.title("Request Statistics")
+        dialog.geometry("760x420")
+        dialog.attributes('-topmost', True)
+        dialog.transient(self.window)
+        
+        stats_display = ctk.CTkTextbox(dialog, wrap="none", font=("Consolas", 11))
+        stats_display.pack(fill="both", expand=True, padx=15, pady=(15, 5))
+        
+        def render():
+            if not dialog.winfo_exists():
+                return
+            lines = [
+                f"{'model':<18}{'mode':<13}{'reqs':>5}{'cache':>7}"
+                f"{'first p50/p95/p99 (s)':>24}{'total p50/p95/p99 (s)':>24}{'tok in/out':>14}",
+                "-" * 105
+            ]
+            for model, mode, count, hit_rate, first_chunk, total, tokens_in, tokens_out in self.metrics.summary_rows():
+                lines.append(
+                    f"{model:<18}{mode:<13}{count:>5}{hit_rate:>7.0%}"
+                    f"{'/'.join(f'{v:.2f}' for v in first_chunk):>24}{'/'.join(f'{v:.2f}' for v in total):>24}"
+                    f"{f'{tokens_in}/{tokens_out}':>14}"
+                )
+            if len(lines) == 2:
+                lines.append("No requests yet.")
+            lines.append("")
+            lines.append(f"In flight: {self.scheduler.in_flight()}")
+            hotkey = self.metrics.percentile("gemini_hotkey_to_focus_seconds", 0.5)
+            if hotkey is not None:
+                p50, p95, p99 = (self.metrics.percentile("gemini_hotkey_to_focus_seconds", q) * 1000
+                                 for q in self.metrics.QUANTILES)
+                lines.append(f"Hotkey to focus ({self.display_mode}): p50 {p50:.1f} / p95 {p95:.1f} / p99 {p99:.1f} ms "
+                             f"(p95 = {p95 / (1000 / 60):.1f} frames at 60 Hz)")
+            if self.speculative_prefetch:
+                spec = self.speculation_stats
+                lines.append(f"Speculative prefetch: {spec['adopted']} adopted ({spec['saved']:.1f}s saved), "
+                             f"{spec['discarded']} discarded ({spec['wasted']:.1f}s wasted)")
+            if self.history_ready.is_set() and self.response_cache:
+                cache = self.response_cache.stats()
+                lines.append(f"Response cache: {cache['hits']} hits / {cache['misses']} misses, {cache['entries']} entries")
+            if isinstance(self.backend, StubBackend):
+                lines.append(f"Stub backend: {self.backend.stats()}")
+            lines.append(f"Prometheus export: {os.path.abspath(self.metrics.path)}")
+            
+            stats_display.configure(state="normal")
+            stats_display.delete("1.0", "end")
+            stats_display.insert("1.0", "\n".join(lines))
+            stats_display.configure(state="disabled")
+            dialog.after(1000, render)
+        
+        close_btn = ctk.CTkButton(dialog, text="Close", command=dialog.destroy)
+        close_btn.pack(pady=10)
+        dialog.bind("<Escape>", lambda e: dialog.destroy())
+        render()
+    
+    def show_cache_stats(self, clear=False):
+        """Show response cache statistics, optionally emptying the cache first"""
+        if not self.history_ready.is_set():
+            messagebox.showinfo("Response Cache", "⏳ The cache is still loading, try again in a moment")
+            return
+        if clear:
+            self.response_cache.clear()
+        stats = self.response_cache.stats()
+        messagebox.showinfo(
+            "Response Cache",
+            f"💾 Entries: {stats['entries']} ({stats['bytes'] / 1024:.1f} KB)\n"
+            f"✅ Hits: {stats['hits']}\n"
+            f"❌ Misses: {stats['misses']}\n"
+            f"📈 Hit rate: {stats['hit_rate']:.0%}\n\n"
+            f"Start a query with ! to bypass the cache and refresh its answer."
+        )
     
     def show_help(self):
         """Show help dialog"""
@@ -700,6 +4449,7 @@ Click the "Commands" button below for a list of quick actions like summarizing,
 • Enter - Send message
 • Ctrl+Enter - New line in message
 • Esc - Hide window
+• !your question - Skip the response cache and fetch a fresh answer
 
 🚀 QUICK COMMANDS:
 • Use the "Commands" button for easy access to common tasks like summarizing, translating, and code analysis.
@@ -790,15 +4540,17 @@ Your key will be stored securely on your device.""",
             
             try:
                 # Test the API key with a simple request
-                genai.configure(api_key=key)
-                test_model = genai.GenerativeModel('gemini-1.5-pro')
+                load_genai().configure(api_key=key)
+                test_model = load_genai().GenerativeModel(
+                    self.fast_model if self.current_model == AUTO_MODEL else self.current_model
+                )
                 # Try a minimal generation to verify the key works
                 test_response = test_model.generate_content("Hi")
                 
                 # If we get here, the key works - now save it
                 if self.save_api_key(key):
                     self.api_key = key
-                    self.model = test_model
+                    self.configure_backend(key)
                     self.update_status()
                     messagebox.showinfo("Success", "✅ API key saved and verified successfully!")
                     dialog.destroy()
@@ -814,8 +4566,7 @@ Your key will be stored securely on your device.""",
                     # Save anyway in case it's just a network issue
                     if self.save_api_key(key):
                         self.api_key = key
-                        genai.configure(api_key=key)
-                        self.model = genai.GenerativeModel('gemini-1.5-pro')
+                        self.configure_backend(key)
                         self.update_status()
                         dialog.destroy()
                 save_btn.configure(text="Save & Test", state="normal")
@@ -828,8 +4579,7 @@ Your key will be stored securely on your device.""",
             
             if self.save_api_key(key):
                 self.api_key = key
-                genai.configure(api_key=key)
-                self.model = genai.GenerativeModel('gemini-1.5-pro')
+                self.configure_backend(key)
                 self.update_status()
                 messagebox.showinfo("Saved", "✅ API key saved successfully!\n(Not tested - will verify on first use)")
                 dialog.destroy()
@@ -857,35 +4607,186 @@ Your key will be stored securely on your device.""",
     
     def run(self):
         """Run the application"""
-        print("\n🚀 Gemini Everywhere Starting...")
-        print("📝 Press Ctrl+Space anywhere to toggle the overlay!")
-        print("⚙️  Configure your API key when prompted.")
-        print("❌ Close the window or press Ctrl+C to quit")
-        print("-" * 50)
+        logger.info("🚀 Gemini Everywhere Starting...")
+        logger.info("📝 Press Ctrl+Space anywhere to toggle the overlay!")
+        logger.info("⚙️  Configure your API key when prompted.")
+        logger.info("❌ Close the window or press Ctrl+C to quit")
         
         try:
+            if self.profiler.enabled:
+                self.window.after_idle(lambda: self.profiler.milestone("event loop running"))
+                self.window.after(100, self.report_startup_profile)
+            
+            if self.benchmark:
+                self.window.after(0, self.show_window)
+                self.window.after(500, self.start_benchmark)
+            
             # Show window initially for first-time setup
-            if not self.api_key:
-                print("👋 Opening window for initial setup...")
+            if not self.api_key and self.backend.requires_api_key:
+                logger.info("👋 Opening window for initial setup...")
                 self.window.after(1000, self.show_window)  # Show after 1 second
             
             # Run the GUI event loop
             self.window.mainloop()
             
         except KeyboardInterrupt:
-            print("\n👋 Shutting down Gemini Everywhere...")
+            logger.info("👋 Shutting down Gemini Everywhere...")
         except Exception as e:
-            print(f"Error running application: {e}")
+            logger.exception("Error running application: %s", e)
         finally:
-            self.running = False
+            self.shutdown()
+    
+    def shutdown(self):
+        """Stop the workers, release API caches and close the stores"""
+        self.running = False
+        if self.ipc:
+            self.ipc.close()
+        self.scheduler.shutdown()
+        self.backend.close()
+        self.metrics.export()
+        if self.history_ready.is_set() and self.sessions:
+            self.sessions.close()
+            self.response_cache.close()
+
+def ask_running_instance(instance, query, mode=None, model=None):
+    """--ask: stream a reply from the running overlay to stdout; returns the exit status"""
+    if instance is None:
+        logger.error("No running Gemini Everywhere instance to ask; start the overlay first")
+        shutdown_logging()
+        return 1
+    response = ipc_request(instance, "POST", "/query", {"query": query, "mode": mode, "model": model, "stream": True})
+    status = 1
+    for line in response:
+        event = json.loads(line)
+        if "text" in event:
+            sys.stdout.write(event["text"])
+            sys.stdout.flush()
+        elif event.get("status") == "ok":
+            status = 0
+            sys.stdout.write("\n")
+        else:
+            logger.error("Query failed: %s", event.get("error"))
+    shutdown_logging()
+    return status
+
 
 def main():
+    parser = argparse.ArgumentParser(description="Gemini Everywhere overlay")
+    parser.add_argument("--startup-profile", action="store_true", help="print how long each startup phase took")
+    parser.add_argument("--backend", choices=["gemini", "stub"], default=os.getenv("GEMINI_OVERLAY_BACKEND", "gemini"),
+                        help="model backend; 'stub' answers locally without a key or network")
+    parser.add_argument("--stub-latency", type=float, default=0.3, help="stub: seconds before the first chunk")
+    parser.add_argument("--stub-chunk-size", type=int, default=24, help="stub: characters per streamed chunk")
+    parser.add_argument("--stub-chunk-delay", type=float, default=0.02, help="stub: seconds between chunks")
+    parser.add_argument("--stub-error-rate", type=float, default=0.0, help="stub: fraction of requests that fail")
+    parser.add_argument("--stub-script", help="stub: JSON file mapping prompt substrings to replies")
+    parser.add_argument("--metrics-port", type=int, default=0, metavar="PORT",
+                        help="also serve Prometheus metrics at http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--rate-limit", action="append", default=[], metavar="MODEL=RPM,TPM",
+                        help="client-side quota for a model, e.g. gemini-2.5-pro=150,2000000 (0 = unlimited)")
+    parser.add_argument("--hedge", action="store_true",
+                        help="hedge every slow streamed request with a backup model, not only Auto-routed ones")
+    parser.add_argument("--free-tier", action="store_true",
+                        help="hold requests to the Gemini free tier quotas (overridden per model by --rate-limit)")
+    parser.add_argument("--display", choices=["standby", "classic"], default="standby",
+                        help="standby keeps the hidden overlay laid out so Ctrl+Space only maps it; "
+                             "classic re-raises and re-applies -topmost on every show")
+    parser.add_argument("--speculate", action="store_true",
+                        help="start quick commands in the background once the typed input settles")
+    parser.add_argument("--retrieval", action="store_true",
+                        help="add relevant earlier exchanges from a local vector index (needs NumPy) to prompts")
+    parser.add_argument("--no-fallback", action="store_true",
+                        help="never answer Pro requests with Flash when Pro is throttled or slow")
+    parser.add_argument("--log-level", default=os.getenv("GEMINI_OVERLAY_LOG_LEVEL", "INFO"),
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"], type=str.upper,
+                        help="minimum level written to gemini_overlay.log and the console")
+    parser.add_argument("--ask", metavar="QUERY",
+                        help="send QUERY (e.g. '/translate hola') to the running overlay and print the streamed reply")
+    parser.add_argument("--no-ipc", action="store_true", help="don't expose the localhost API for other tools")
+    parser.add_argument("--batch", metavar="JSONL", help="run the prompts in a JSONL file without a window and exit")
+    parser.add_argument("--output", metavar="JSONL",
+                        help="batch: results file, appended to and resumed from (default: <input>.results.jsonl)")
+    parser.add_argument("--parallel", type=int, default=4, help="batch: prompts in flight at once")
+    parser.add_argument("--mode", help="batch: mode for lines without a \"mode\" key")
+    parser.add_argument("--model", help="batch: model id (or 'auto') for lines without a \"model\" key")
+    parser.add_argument("--prompt-field", default="prompt", help="batch: key holding the prompt text")
+    parser.add_argument("--id-field", default="id", help="batch: key holding each prompt's id")
+    parser.add_argument("--bench-memory", type=int, nargs="?", const=100000, metavar="N",
+                        help="print the memory N chat messages take as dicts and as Message records, then exit")
+    parser.add_argument("--bench", type=int, default=0, metavar="N",
+                        help="send N queries through the overlay, print latencies and exit")
+    parser.add_argument("--bench-pinned-kb", type=int, default=0, metavar="KB",
+                        help="pin KB of synthetic context during --bench (shows context-cache savings)")
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+    
+    if args.bench_memory:
+        benchmark_message_memory(args.bench_memory)
+        shutdown_logging()
+        return
+    
+    rate_limits = dict(FREE_TIER_RATE_LIMITS) if args.free_tier else {}
+    if args.rate_limit:
+        for spec in args.rate_limit:
+            model_id, _, limits = spec.partition("=")
+            rpm, _, tpm = limits.partition(",")
+            rate_limits[model_id.strip()] = (int(rpm or 0), int(tpm or 0))
+    
+    script = None
+    if args.stub_script:
+        with open(args.stub_script, 'r', encoding='utf-8') as f:
+            script = json.load(f)
+    backend = create_backend(
+        args.backend,
+        latency=args.stub_latency,
+        chunk_size=args.stub_chunk_size,
+        chunk_delay=args.stub_chunk_delay,
+        error_rate=args.stub_error_rate,
+        script=script
+    )
+    
+    if not args.batch:
+        instance = find_running_instance()
+        if args.ask:
+            sys.exit(ask_running_instance(instance, args.ask, args.mode, args.model))
+        if instance and not args.no_ipc:
+            # Already running: bring that overlay up instead of hooking the hotkey twice
+            ipc_request(instance, "POST", "/show", {}, timeout=2.0).read()
+            logger.info("Gemini Everywhere is already running (pid %s); showed its window", instance["pid"])
+            shutdown_logging()
+            return
+    
+    if args.batch:
+        app = GeminiEverywhere(backend=backend, rate_limits=rate_limits, model_fallback=not args.no_fallback,
+                               headless=True, hedge=args.hedge)
+        output = args.output or os.path.splitext(args.batch)[0] + ".results.jsonl"
+        runner = BatchRunner(app, args.batch, output, parallel=args.parallel, prompt_field=args.prompt_field,
+                             id_field=args.id_field, mode=args.mode, model=args.model)
+        try:
+            failed = runner.run()
+        except KeyboardInterrupt:
+            logger.info("📦 Batch interrupted; rerun the same command to resume")
+            failed = 1
+        finally:
+            app.shutdown()
+            shutdown_logging()
+        sys.exit(1 if failed else 0)
+    
     try:
-        app = GeminiEverywhere()
+        app = GeminiEverywhere(startup_profile=args.startup_profile, backend=backend, bench=args.bench,
+                               bench_pinned_kb=args.bench_pinned_kb, rate_limits=rate_limits,
+                               model_fallback=not args.no_fallback, speculate=args.speculate,
+                               display_mode=args.display, ipc=not args.no_ipc, retrieval=args.retrieval,
+                               hedge=args.hedge)
+        if args.metrics_port:
+            app.metrics.serve(args.metrics_port)
         app.run()
     except Exception as e:
-        print(f"Failed to start application: {e}")
+        logger.exception("Failed to start application: %s", e)
+        shutdown_logging()
         input("Press Enter to exit...")
+    finally:
+        shutdown_logging()
 
 if __name__ == "__main__":
     main()